@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+import sys
+import asyncio
+import alien
+
+
+async def stat_all(directory: str, pattern: str):
+    # one connection for all the commands; the stat requests are pipelined
+    async with alien.AlienClient() as client:
+        files = await client.find(directory, pattern)
+        for info in await asyncio.gather(*(client.stat(f.lfn) for f in files)):
+            print(info.lfn, info.size, info.md5, flush = True)
+
+
+def main():
+    sys.argv.pop(0)  # remove the name of the script
+    if len(sys.argv) < 2:
+        print("client.py <directory> <pattern>", flush = True)
+        sys.exit(64)  # EX_USAGE /* command line usage error */
+    asyncio.get_event_loop().run_until_complete(stat_all(sys.argv[0], sys.argv[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import tracemalloc
+import alien
+
+
+def synthetic_files(nr_files: int):
+    # a dataset like layout: runs / chunks / files
+    for i in range(nr_files):
+        lfn = f'/alice/data/2018/LHC18q/000{295585 + i // 100000}/pass1/{(i // 1000) % 100:03d}/AO2D_{i % 1000:03d}.root'
+        yield lfn, '/home/user/data' + lfn
+
+
+def lists_plan(nr_files: int):
+    # the former representation: parallel lists of paths, of the envelope answers and of dicts for the copy jobs
+    src_filelist, dst_filelist, envelope_list, url_list_src, url_list_dst = [], [], [], [], []
+    for src, dst in synthetic_files(nr_files):
+        src_filelist.append(src)
+        answer = {"metadata": {"error": ""}, "results": [{"url": 'root://eosalice.cern.ch:1094//' + str(len(src_filelist)), "se": 'ALICE::CERN::EOS', "size": "1073741824", "md5": "0" * 32, "envelope": "E" * 1024}]}
+        envelope_list.append({"lfn": src, "answer": json.dumps(answer)})  # a signed envelope is about 1 KiB
+        dst_filelist.append(dst)
+        url_list_src.append({"url": '/tmp/' + src.replace("/", "%%") + ".meta4", "se": 'ALICE::CERN::EOS', "size": 1073741824})
+        url_list_dst.append({"url": dst})
+    return src_filelist, dst_filelist, envelope_list, url_list_src, url_list_dst
+
+
+def copy_plan(nr_files: int):
+    plan = alien.CopyPlan()
+    for file_idx, (src, dst) in enumerate(synthetic_files(nr_files)):
+        plan.add(src, dst)
+        plan.size[file_idx] = 1073741824
+        plan.set_se(file_idx, 'ALICE::CERN::EOS')
+    return plan
+
+
+def upload_servers(file_idx: int) -> list:
+    # two destination replicas, each with its own signed envelope of about 1 KiB
+    return [{"url": f'root://{se.lower()}.cern.ch:1094//{file_idx}', "se": se, "guid": '0' * 36, "envelope": f"{file_idx:016d}" + "E" * 1008} for se in ('ALICE::CERN::EOS', 'ALICE::FZK::SE')]
+
+
+def lists_plan_upload(nr_files: int):
+    src_filelist, dst_filelist, envelope_list, url_list_src, url_list_dst = [], [], [], [], []
+    for file_idx, (lfn, local) in enumerate(synthetic_files(nr_files)):
+        src_filelist.append(local)
+        dst_filelist.append(lfn)
+        servers = upload_servers(file_idx)
+        envelope_list.append({"lfn": lfn, "answer": json.dumps({"metadata": {"error": ""}, "results": servers})})
+        for server in servers:
+            url_list_dst.append({"url": server['url'] + "?authz=" + server['envelope'], "se": server['se'], "size": 1073741824})
+            url_list_src.append({"url": local})
+    return src_filelist, dst_filelist, envelope_list, url_list_src, url_list_dst
+
+
+def copy_plan_upload(nr_files: int):
+    # the envelopes are needed by the transfer and by the commit: they are spooled to a temporary file, not counted here
+    plan = alien.CopyPlan()
+    for file_idx, (lfn, local) in enumerate(synthetic_files(nr_files)):
+        plan.add(local, lfn)
+        plan.size[file_idx] = 1073741824
+        plan.set_replicas(file_idx, [(server['url'], server['se'], server['guid'], server['envelope']) for server in upload_servers(file_idx)])
+    return plan
+
+
+def measure(build, nr_files: int) -> int:
+    tracemalloc.start()
+    plan = build(nr_files)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if isinstance(plan, alien.CopyPlan): plan.close()
+    del plan
+    return size
+
+
+def main():
+    sys.argv.pop(0)  # remove the name of the script
+    nr_files = int(sys.argv[0]) if sys.argv else 200000  # the former lists of an upload of 1M files need about 6 GiB
+    for direction, builds in (('download', (('lists', lists_plan), ('CopyPlan', copy_plan))),
+                              ('upload', (('lists', lists_plan_upload), ('CopyPlan', copy_plan_upload)))):
+        print(f"memory of the copy plan of {nr_files} files, {direction}", flush = True)
+        for name, build in builds:
+            size = measure(build, nr_files)
+            print(f"{name:>10}: {size / 1048576:8.1f} MiB  {size / nr_files:6.0f} bytes/file", flush = True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,24 @@
 
 import sys
 import json
+import asyncio
 import alien
 
 
+async def send_cmd(cmd: str, args: list) -> dict:
+    async with alien.AlienClient() as client:
+        return json.loads(await client.request(cmd, args))
+
+
 def main():
     sys.argv.pop(0)  # remove the name of the script(alien.py)
-    cmd = ' '.join(sys.argv)
-    out = alien.AlienSendCmd(alien.CreateJsonCommand(cmd))
+    if not sys.argv:
+        print("send_cmd.py <command> [arguments]", flush = True)
+        sys.exit(64)  # EX_USAGE /* command line usage error */
+    cmd = sys.argv.pop(0)
+    out = asyncio.get_event_loop().run_until_complete(send_cmd(cmd, sys.argv))
     print(json.dumps(out, sort_keys=True, indent=4), flush = True)
+    sys.exit(int(out['metadata'].get('exitcode', 0)))
 
 
 if __name__ == '__main__':
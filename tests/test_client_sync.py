@@ -0,0 +1,61 @@
+import json
+import threading
+import pytest
+
+pytest.importorskip('websockets')
+pytest.importorskip('OpenSSL')
+pytest.importorskip('async_stagger')
+alien = pytest.importorskip('xjalienfs.alien')
+
+
+class FakeServer:
+    """Connection answering like the central services the few commands used by the test"""
+    def __init__(self):
+        self.answers = []
+
+    async def send(self, message):
+        jsoncmd = json.loads(message)
+        cmd, args = jsoncmd['command'], jsoncmd['options']
+        results = [{'message': cmd}]
+        if cmd == 'stat': results = [{'lfn': args[-1], 'type': 'f', 'size': '3', 'md5': '0' * 32}]
+        if cmd == 'access': results = [{'url': 'root://se.cern.ch//x', 'se': 'ALICE::CERN::EOS', 'size': '3', 'md5': '0' * 32, 'envelope': 'E'}]
+        if cmd == 'ls': results = [{'message': 'a.root'}, {'message': 'b.root'}]
+        self.answers.append(json.dumps({'metadata': {'exitcode': '0', 'error': '', 'currentdir': '/alice/'}, 'results': results}))
+
+    async def recv(self):
+        return self.answers.pop(0)
+
+    async def close(self):
+        pass
+
+
+def test_ls_during_cp(monkeypatch, tmp_path):
+    """A transfer in progress in one thread does not block the calls of the other threads"""
+    async def fake_connect(self):
+        return alien.AlienWebSocket(FakeServer(), lambda: self.currentdir)
+
+    transfer_started = threading.Event()
+    transfer_release = threading.Event()
+
+    def fake_copy(jobs, isDownload, xrd_cp_args, nr_jobs = 0):
+        list(jobs)
+        transfer_started.set()
+        assert transfer_release.wait(10)
+        return []
+
+    monkeypatch.setenv('TMPDIR', str(tmp_path))
+    monkeypatch.setattr(alien, 'TOKEN_RENEW', 0)
+    monkeypatch.setattr(alien, 'metacache', None)
+    monkeypatch.setattr(alien.AlienClient, '_connect', fake_connect)
+    monkeypatch.setattr(alien, 'XrdCopy', fake_copy)
+
+    with alien.AlienClientSync(timeout = 10) as client:
+        copy = threading.Thread(target = client.cp, args = ('alien:/alice/a.root', 'file:' + str(tmp_path) + '/'))
+        copy.start()
+        try:
+            assert transfer_started.wait(10)
+            assert client.ls('/alice/') == ['a.root', 'b.root']  # answered while the transfer is still in progress
+        finally:
+            transfer_release.set()
+            copy.join(10)
+        assert not copy.is_alive()
@@ -0,0 +1,60 @@
+import json
+import random
+import pytest
+
+pytest.importorskip('websockets')
+pytest.importorskip('OpenSSL')
+pytest.importorskip('async_stagger')
+alien = pytest.importorskip('xjalienfs.alien')
+
+METADATA = {'exitcode': '0', 'error': '', 'currentdir': '/alice/'}
+
+
+def check(message: str):
+    """JsonAnswer gives the same metadata and results as json.loads"""
+    expected = json.loads(message)
+    answer = alien.JsonAnswer(message)
+    assert answer.metadata == expected.get('metadata', {})
+    assert list(answer.results()) == expected['results']
+    assert answer.count() == len(expected['results'])
+
+
+@pytest.mark.parametrize('results', [
+    [],
+    [{}],
+    [{'lfn': '/alice/a.root', 'size': '3'}, {'lfn': '/alice/b.root', 'size': '4'}],
+    [{'message': 'a "quoted" \\ back\\slash\nnew line'}, {'message': 'non ascii é ü 中'}],
+    [{'list': [], 'nested': {'a': [1, 2.5, None, True, False]}}],
+    [']', ',', '{', '}', '"'],
+])
+@pytest.mark.parametrize('dumps_args', [{}, {'indent': 2}, {'separators': (',', ':')}, {'indent': '\t'}, {'ensure_ascii': False}])
+def test_like_json_loads(results, dumps_args):
+    check(json.dumps({'metadata': METADATA, 'results': results}, **dumps_args))
+    check(json.dumps({'results': results, 'metadata': METADATA}, **dumps_args))  # results first
+    check(json.dumps({'results': results, 'other': {'results': [0]}, 'metadata': METADATA}, **dumps_args))
+    check(json.dumps({'other': [results], 'metadata': METADATA, 'results': results}, **dumps_args))
+
+
+def test_like_json_loads_random():
+    rng = random.Random(1)
+
+    def value(depth: int = 0):
+        choice = rng.random()
+        if depth > 2 or choice < 0.3: return rng.choice([1, -2.5e3, 'a"b\\', 'é', '', ']', ',{', None, True, False])
+        if choice < 0.6: return [value(depth + 1) for _ in range(rng.randint(0, 3))]
+        return {str(rng.randint(0, 9)): value(depth + 1) for _ in range(rng.randint(0, 3))}
+
+    for _ in range(1000):
+        results = [value() for _ in range(rng.randint(0, 5))]
+        items = [('metadata', METADATA), ('results', results), ('other', value())]
+        rng.shuffle(items)
+        dumps_args = rng.choice([{}, {'indent': 2}, {'separators': (',', ':')}, {'ensure_ascii': False}])
+        check(json.dumps(dict(items), **dumps_args))
+
+
+def test_truncated():
+    message = json.dumps({'metadata': METADATA, 'results': [{'lfn': '/alice/a.root'}, {'lfn': '/alice/b.root'}]})
+    for end in range(len(message) - 1):  # the final } is not needed, nothing is read after metadata and results
+        with pytest.raises(ValueError):
+            answer = alien.JsonAnswer(message[:end])
+            list(answer.results())
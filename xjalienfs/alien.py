@@ -12,6 +12,12 @@ import traceback
 import logging
 import ssl
 import uuid
+import threading
+import posixpath
+import bisect
+import math
+import itertools
+import fcntl
 from typing import NamedTuple
 import OpenSSL
 import shlex
@@ -21,6 +27,8 @@ import time
 from datetime import datetime
 from pathlib import Path
 from enum import Enum
+from collections import deque
+from array import array
 from urllib.parse import urlparse
 import asyncio
 import async_stagger
@@ -39,13 +47,81 @@ if sys.version_info[0] != 3 or sys.version_info[1] < 6:
 
 # environment debug variable
 JSON_OUT = os.getenv('ALIENPY_JSON', '')
+NDJSON_OUT = os.getenv('ALIENPY_NDJSON', '')
 JSONRAW_OUT = os.getenv('ALIENPY_JSONRAW', '')
 DEBUG = os.getenv('ALIENPY_DEBUG', '')
 XRDDEBUG = os.getenv('ALIENPY_XRDDEBUG', '')
 TIME_CONNECT = os.getenv('ALIENPY_TIMECONNECT', '')
 
+# persistent cache of downloaded lfns
+CACHE_DIR = os.getenv('ALIENPY_CACHE_DIR', Path.home().as_posix() + '/.cache/alienpy')
+CACHE_CONTENT = CACHE_DIR + '/content'  # the files, each with its .meta; the only directory subject to eviction
+CACHE_SIZE = int(os.getenv('ALIENPY_CACHE_SIZE', '256')) * 1024 * 1024  # MiB; 0 disables the cache
+
+# validity in seconds of the cached session information (user, home, command list); 0 disables the cache
+SESSION_TTL = float(os.getenv('ALIENPY_SESSION_TTL', '86400'))
+
+# initial number of entries requested per page by the paginated find; 0 disables the pagination
+FIND_PAGESIZE = int(os.getenv('ALIENPY_FIND_PAGESIZE', '20000'))
+FIND_PAGESIZE_MIN = int(1000)
+FIND_PAGESIZE_MAX = int(500000)
+FIND_PAGE_TIME = float(2)  # page size is adapted to have answers in about this many seconds
+
+# the token is renewed when it has less than this many seconds left; 0 renews only expired tokens at connection
+TOKEN_RENEW = float(os.getenv('ALIENPY_TOKEN_RENEW', '3600'))
+
+# validity in seconds of the cached listing of the grid current directory
+CWD_LIST_TTL = float(os.getenv('ALIENPY_CWD_TTL', '60'))
+
+# commands that resolve relative paths against the listing of the current directory
+CMDS_EXPAND_PATH = ('ls', 'stat', 'xrdstat', 'rm', 'lfn2guid', 'cp', 'cat', 'less', 'more', 'head', 'tail', 'mcedit', 'vi', 'nano', 'vim', 'edit', 'sensible-editor')
+
+# opt-in persistent cache of catalogue metadata; 1 for the default location in the cache dir or the path of the sqlite file
+METACACHE = os.getenv('ALIENPY_METACACHE', '')
+METACACHE_TTL = float(os.getenv('ALIENPY_METACACHE_TTL', '3600'))  # validity in seconds of cached answers
+METACACHE_NEGTTL = float(os.getenv('ALIENPY_METACACHE_NEGTTL', '60'))  # validity in seconds of cached errors (e.g. no such file)
+
+# commands with answers served from the metadata cache
+CMDS_METACACHE = ('stat', 'whereis', 'lfn2guid', 'guid2lfn')
+
+# commands that modify the catalogue entries of their path arguments
+CMDS_CATALOGUE_MUTATING = ('rm', 'rmdir', 'mv', 'mkdir', 'touch', 'ln', 'chown', 'mirror', 'addMirror', 'deleteMirror')
+
+# commands implemented (or extended) by alien.py itself
+CMDS_CLIENT = ('bulkstat', 'bulksubmit', 'cat', 'certinfo', 'cp', 'edit', 'head', 'help', 'less', 'mcedit', 'more', 'nano', 'prompt', 'quota', 'stats', 'tail', 'time', 'token', 'vi', 'vim', 'watch')
+
+# commands that change the content of the current directory
+CMDS_CWD_MUTATING = ('cd', 'mkdir', 'rmdir', 'rm', 'mv', 'touch', 'ln')  # cp uploads invalidate the listing in ProcessXrootdCp
+
+# server commands that only read the catalogue or the task queue; consecutive ones of a script (-f) are sent concurrently
+CMDS_READONLY = ('ls', 'stat', 'whereis', 'lfn2guid', 'guid2lfn', 'pwd', 'whoami', 'type', 'du', 'df', 'md5sum', 'xrdstat',
+                 'ps', 'masterjob', 'top', 'jquota', 'fquota', 'listSEs', 'listSEDistance', 'listTransfer', 'listFilesFromCollection',
+                 'groups', 'whois', 'w', 'uptime', 'motd', 'packages', 'uuid')
+
+# commands that can be sent again (once) when the connection was lost before their answer; find -x is excluded in cmd_replayable
+CMDS_IDEMPOTENT = CMDS_READONLY + ('cd', 'find', 'commandlist')
+
+# websocket close codes after which the same request would fail again: protocol error, unsupported or invalid data, policy, message too big, extension
+WS_CLOSE_PERMANENT = (1002, 1003, 1007, 1008, 1009, 1010)
+
+# number of reconnection attempts, with increasing delays, when the connection is lost; 0 disables the reconnection
+RECONNECT_TRIES = int(os.getenv('ALIENPY_RECONNECT', '5'))
+
+# maximum number of commands of a script (-f) in flight at once
+BATCH_JOBS = int(os.getenv('ALIENPY_BATCH_JOBS', '16'))
+
+# job states after which a job does not change anymore
+JOB_STATES_FINAL = ('DONE', 'DONE_WARN', 'KILLED', 'FAILED', 'EXPIRED')
+
+# if set, the statistics of the session (see the stats command) are written as json to this file at exit
+STATS_FILE = os.getenv('ALIENPY_STATS', '')
+
+# opt-in profiling of the session: cpu (cProfile), mem (tracemalloc) or both (1 or cpu,mem); the files are written at exit
+PROFILE = os.getenv('ALIENPY_PROFILE', '')
+PROFILE_FILE = os.getenv('ALIENPY_PROFILE_FILE', os.getenv('TMPDIR', '/tmp') + '/alienpy_profile_' + str(os.getpid()))  # prefix of the files
+
 # global session state;
-AlienSessionInfo = {'alienHome': '', 'currentdir': '', 'cwd_list': [], 'commandlist': [], 'user': '', 'error': '', 'exitcode': '0', 'show_date': False, 'show_lpwd': False, 'templist': []}
+AlienSessionInfo = {'alienHome': '', 'currentdir': '', 'cwd_list': [], 'cwd_index': [], 'cwd_list_dir': '', 'cwd_list_time': 0, 'commandlist': [], 'user': '', 'server': '', 'cert_subject': '', 'token_check': 0, 'error': '', 'exitcode': '0', 'show_date': False, 'show_lpwd': False, 'templist': []}
 
 
 class XrdCpArgs(NamedTuple):
@@ -58,6 +134,178 @@ class XrdCpArgs(NamedTuple):
     posc: bool
     hashtype: str
     streams: int
+    se_limit: int
+    rate: int
+    prio: int
+
+
+class AlienResult(NamedTuple):
+    """The answer of a server command as returned by AlienClient.run"""
+    exitcode: int
+    error: str
+    results: list
+    currentdir: str
+
+    @classmethod
+    def from_answer(cls, answer: str):
+        json_dict = json.loads(answer)
+        metadata = json_dict["metadata"]
+        return cls(int(metadata.get("exitcode", 0)), metadata.get("error", ''), json_dict['results'], metadata.get("currentdir", ''))
+
+
+class StatInfo(NamedTuple):
+    """A catalogue entry as given by stat and find"""
+    lfn: str
+    type: str
+    size: int
+    md5: str
+    guid: str
+    owner: str
+    gowner: str
+    perm: str
+    ctime: str
+
+    @classmethod
+    def from_dict(cls, entry: dict):
+        return cls(entry.get('lfn', ''), entry.get('type', ''), int(entry.get('size') or 0), entry.get('md5', ''), entry.get('guid', ''),
+                   entry.get('owner', ''), entry.get('gowner', ''), entry.get('perm', ''), entry.get('ctime', ''))
+
+
+class Replica(NamedTuple):
+    """A replica of a lfn with the access envelope, as given by access"""
+    url: str
+    se: str
+    envelope: str
+    guid: str
+
+    @classmethod
+    def from_dict(cls, entry: dict):
+        return cls(entry.get('url', ''), entry.get('se', ''), entry.get('envelope', ''), entry.get('guid', ''))
+
+
+class LatencyStats:
+    """Count, errors, bytes and latency histogram of each kind of operation; cheap enough to be always on
+    The histogram buckets are 2^(1/4) wide (in microseconds) so the percentiles are at most 19% above the real value"""
+    BUCKETS_PER_OCTAVE = 4
+
+    def __init__(self):
+        self.ops = {}
+        self.lock = threading.Lock()  # operations are recorded also from XRootD callbacks and background loops
+
+    def record(self, name: str, seconds: float, nbytes: int = 0, error: bool = False):
+        bucket = int(math.log2(max(seconds * 1e6, 1)) * self.BUCKETS_PER_OCTAVE)
+        with self.lock:
+            op = self.ops.get(name)
+            if op is None: op = self.ops[name] = {'count': 0, 'errors': 0, 'bytes': 0, 'time': 0.0, 'max': 0.0, 'hist': {}}
+            op['count'] += 1
+            if error: op['errors'] += 1
+            op['bytes'] += int(nbytes)
+            op['time'] += seconds
+            op['max'] = max(op['max'], seconds)
+            op['hist'][bucket] = op['hist'].get(bucket, 0) + 1
+
+    def percentile(self, op: dict, q: float) -> float:
+        rank = q * op['count']
+        seen = 0
+        for bucket in sorted(op['hist']):
+            seen += op['hist'][bucket]
+            if seen >= rank: return min(2 ** ((bucket + 1) / self.BUCKETS_PER_OCTAVE) / 1e6, op['max'])
+        return op['max']
+
+    def summary(self) -> list:
+        with self.lock:
+            return [{'name': name, 'count': op['count'], 'errors': op['errors'], 'bytes': op['bytes'], 'time': op['time'],
+                     'p50': self.percentile(op, 0.5), 'p90': self.percentile(op, 0.9), 'p99': self.percentile(op, 0.99), 'max': op['max']}
+                    for name, op in sorted(self.ops.items())]
+
+    def reset(self):
+        with self.lock: self.ops.clear()
+
+    def dump(self, fname: str):
+        try:
+            with open(fname, 'w') as f: json.dump({'ts': time.time(), 'pid': os.getpid(), 'server': AlienSessionInfo['server'], 'ops': self.summary()}, f, indent = 1)
+        except OSError as e:
+            logging.error(f"Could not write the statistics to {fname} : {e}")
+
+
+stats = LatencyStats()
+if STATS_FILE: atexit.register(stats.dump, STATS_FILE)  # main() ends with os._exit and writes them itself
+
+
+class SessionProfiler:
+    """cProfile and/or tracemalloc for the whole session, with the phases marked by PhaseMarkers
+    Written at stop as <prefix>.prof (pstats, for snakeviz/gprof2dot), <prefix>.tracemalloc (snapshot),
+    <prefix>.mem.txt (top allocations) and <prefix>.phases.json"""
+    def __init__(self, modes: str, prefix: str):
+        modes = modes.lower()
+        self.cpu = modes in ('1', 'all') or 'cpu' in modes
+        self.mem = modes in ('1', 'all') or 'mem' in modes
+        self.prefix = prefix
+        self.phases = []
+        self.cprofile = None
+        self.begin = time.time()
+        self.running = False
+
+    def start(self):
+        if self.mem:
+            import tracemalloc
+            tracemalloc.start(25)
+        if self.cpu:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.running = True
+
+    def phase(self, operation: str, phase: str, seconds: float):
+        entry = {'operation': operation, 'phase': phase, 'start': time.time() - seconds - self.begin, 'duration': seconds}
+        if self.mem:
+            import tracemalloc
+            entry['mem_current'], entry['mem_peak'] = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, 'reset_peak'): tracemalloc.reset_peak()  # the peak of each phase, python >= 3.9
+        self.phases.append(entry)
+
+    def stop(self):
+        if not self.running: return
+        self.running = False
+        files = []
+        try:
+            if self.cprofile:
+                self.cprofile.disable()
+                self.cprofile.dump_stats(self.prefix + '.prof')
+                files.append(self.prefix + '.prof')
+            if self.mem:
+                import tracemalloc
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                snapshot.dump(self.prefix + '.tracemalloc')
+                with open(self.prefix + '.mem.txt', 'w') as f:
+                    for stat in snapshot.statistics('lineno')[:50]: print(stat, file = f)
+                files.extend((self.prefix + '.tracemalloc', self.prefix + '.mem.txt'))
+            with open(self.prefix + '.phases.json', 'w') as f: json.dump(self.phases, f, indent = 1)
+            files.append(self.prefix + '.phases.json')
+        except OSError as e:
+            logging.error(f"Could not write the profile to {self.prefix}.* : {e}")
+        if files: print(f"Profile written to: {' '.join(files)}", file = sys.stderr, flush = True)
+
+
+profiler = None
+
+
+class PhaseMarkers:
+    """Time of the consecutive phases of an operation: each mark ends the current phase and starts the next one
+    The phases are recorded in stats as '<operation> <phase>' and in the profile when profiling"""
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.phase = None
+        self.begin = None
+
+    def mark(self, phase: str = None):
+        now = time.time()
+        if self.phase:
+            stats.record(f'{self.operation} {self.phase}', now - self.begin)
+            if profiler: profiler.phase(self.operation, self.phase, now - self.begin)
+        self.phase = phase
+        self.begin = now
 
 
 def cursor_up(lines = 1):
@@ -119,6 +367,9 @@ args are the following :
 -chunks <nr chunks> : number of chunks that should be requested in parallel
 -chunksz <bytes> : chunk size (bytes)
 -T <nr_copy_jobs> : number of parralel copy jobs from a set (for recursive copy)
+-selimit <nr_jobs> : maximum number of concurrent transfers per storage element for all alien.py processes of the user on this node; defaults to ALIENPY_SE_MAXJOBS or unlimited
+-ratelimit <bytes/s> : maximum byte-rate for all alien.py transfers of the user on this node; defaults to ALIENPY_MAXRATE or unlimited
+-prio <priority> : priority of this copy session when competing for storage element slots; higher wins; defaults to 0
 
 for the recursive copy of directories the following options (of the find command) can be used:
 -select <pattern> : select only these files (AliEn find semantics) to be copied; defaults to all "."
@@ -134,17 +385,25 @@ async def getEnvelope(wb: websockets.client.WebSocketClientProtocol, lfn_list: l
     if not wb: return
     access_list = []
     if not lfn_list: return access_list
-    access_type = 'read'
-    if isWrite: access_type = 'write'
     for lfn in lfn_list:
-        get_envelope_arg_list = [access_type, lfn]
-        if not DEBUG: get_envelope_arg_list.insert(0, '-nomsg')
-        if specs: get_envelope_arg_list.append(str(",".join(specs)))
-        result = await SendMsg(wb, 'access', get_envelope_arg_list)
+        result = await SendMsg(wb, 'access', envelope_args(lfn, specs, isWrite))
         access_list.append({"lfn": lfn, "answer": result})
     return access_list
 
 
+def envelope_args(lfn: str, specs: list = [], isWrite: bool = False) -> list:
+    """Arguments of the access command that requests the envelope of lfn"""
+    get_envelope_arg_list = ['write' if isWrite else 'read', lfn]
+    if not DEBUG: get_envelope_arg_list.insert(0, '-nomsg')
+    if specs: get_envelope_arg_list.append(str(",".join(specs)))
+    return get_envelope_arg_list
+
+
+def url_authz(url: str) -> str:
+    """The token (authz parameter) of a storage url"""
+    return next((param for param in str.split(urlparse(url).query, '&') if 'authz=' in param), '').replace('authz=', '')
+
+
 def setDst(file: str = '', parent: int = 0) -> str:
     p = Path(file)
     filename = p.parts[0]
@@ -169,24 +428,111 @@ def expand_path_local(path: str) -> str:
     return exp_path
 
 
+RE_ALIEN_HOME = re.compile(r"\/*\%ALIEN")
+RE_MULTI_SLASH = re.compile(r"\/{2,}")
+
+
+def cwd_has_prefix(prefix: str) -> bool:
+    """True if any entry of the current directory listing starts with prefix; binary search in the sorted index"""
+    index = AlienSessionInfo['cwd_index']
+    idx = bisect.bisect_left(index, prefix)
+    return idx < len(index) and index[idx].startswith(prefix)
+
+
 def expand_path_grid(path: str) -> str:
-    exp_path = re.sub(r"\/*\%ALIEN", AlienSessionInfo['alienHome'], path)
-    exp_path = re.sub(r"^\/*\.{2}", Path(AlienSessionInfo['currentdir']).parents[0].as_posix(), exp_path)
-    exp_path = re.sub(r"^\/*\.{1}", AlienSessionInfo['currentdir'], exp_path)
-    if not exp_path.startswith('/'):
-        path_components = path.split("/")
-        r = re.compile(path_components[0] + "\\/*")
-        matches = list(filter(r.match, AlienSessionInfo['cwd_list']))
-        if matches:
+    exp_path = path
+    if '%ALIEN' in exp_path: exp_path = RE_ALIEN_HOME.sub(lambda m: AlienSessionInfo['alienHome'], exp_path)
+    exp_path_rel = exp_path.lstrip('/')
+    if exp_path_rel.startswith('..'):
+        exp_path = Path(AlienSessionInfo['currentdir']).parents[0].as_posix() + exp_path_rel[2:]
+    elif exp_path_rel.startswith('.'):
+        exp_path = AlienSessionInfo['currentdir'] + exp_path_rel[1:]
+    elif not exp_path.startswith('/'):
+        if cwd_has_prefix(path.split("/", maxsplit = 1)[0]):
             exp_path = AlienSessionInfo['currentdir'] + "/" + exp_path
-    exp_path = re.sub(r"\/{2,}", "/", exp_path)
+    if '//' in exp_path: exp_path = RE_MULTI_SLASH.sub("/", exp_path)
     return exp_path
 
 
+class MetaCache:
+    """Persistent cache of the answers of catalogue lookups (stat, whereis, lfn2guid, guid2lfn)
+    Answers are kept in a sqlite file shared by all processes (a connection per thread), each with the catalogue path it describes;
+    errors are cached for a shorter time and the commands that modify the catalogue remove the entries of their paths"""
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.local = threading.local()  # a sqlite connection can be used only by the thread that opened it
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db: return db
+        import sqlite3
+        Path(self.db_file).parent.mkdir(parents = True, exist_ok = True)
+        db = sqlite3.connect(self.db_file, timeout = 10, isolation_level = None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS replies (key TEXT PRIMARY KEY, path TEXT, reply TEXT, ts REAL, negative INTEGER)')
+        db.execute('CREATE INDEX IF NOT EXISTS replies_path ON replies (path)')
+        self.local.db = db
+        return db
+
+    @staticmethod
+    def key(cmd: str, args: list) -> str:
+        cwd = ''  # relative paths are resolved by the server against the current directory
+        if any(not (arg.startswith('/') or arg.startswith('-')) for arg in args): cwd = AlienSessionInfo['currentdir']
+        return json.dumps([AlienSessionInfo['user'], cwd, cmd, args])
+
+    def get(self, cmd: str, args: list) -> str:
+        row = self.connect().execute('SELECT reply, ts, negative FROM replies WHERE key = ?', (self.key(cmd, args),)).fetchone()
+        if not row: return ''
+        reply, ts, negative = row
+        if time.time() - ts > (METACACHE_NEGTTL if negative else METACACHE_TTL): return ''
+        json_dict = json.loads(reply)
+        json_dict["metadata"]["currentdir"] = AlienSessionInfo['currentdir']  # the answer is replayed in the current session
+        return json.dumps(json_dict)
+
+    def put(self, cmd: str, args: list, reply: str):
+        json_dict = json.loads(reply)
+        metadata = json_dict["metadata"]
+        if str(metadata.get("exitcode", '0')) == '107': return  # ENOTCONN, made by answer_not_connected: a lost connection says nothing about the path
+        negative = int(bool(metadata.get("error")) or str(metadata.get("exitcode", '0')) != '0')
+        path = next((arg for arg in reversed(args) if arg.startswith('/')), '')
+        if not path and json_dict['results'] and isinstance(json_dict['results'][0], dict): path = json_dict['results'][0].get('lfn', '')  # guid lookups
+        self.connect().execute('INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, ?)', (self.key(cmd, args), path, reply, time.time(), negative))
+
+    def invalidate(self, paths: list):
+        db = self.connect()
+        for path in paths:
+            path = path.rstrip('/')
+            db.execute('DELETE FROM replies WHERE path = ? OR path = ? OR substr(path, 1, ?) = ?', (path, path + '/', len(path) + 1, path + '/'))
+
+
+metacache = MetaCache(CACHE_DIR + '/metadata.sqlite' if METACACHE == '1' else METACACHE) if METACACHE else None
+
+
+async def SendMsg_cached(wb: websockets.client.WebSocketClientProtocol, cmd: str, args: list = []) -> str:
+    """SendMsg with the answers of catalogue lookups served from the metadata cache, if enabled"""
+    if not metacache or cmd not in CMDS_METACACHE: return await SendMsg(wb, cmd, args)
+    result = metacache.get(cmd, args)
+    if result: return result
+    result = await SendMsg(wb, cmd, args)
+    if result: metacache.put(cmd, args, result)
+    return result
+
+
+def metacache_invalidate(paths: list):
+    if not metacache: return
+    abs_paths = []
+    for path in paths:
+        if path.startswith('-'): continue
+        path = expand_path_grid(path)
+        if not path.startswith('/'): path = AlienSessionInfo['currentdir'] + '/' + path
+        abs_paths.append(RE_MULTI_SLASH.sub('/', path))
+    metacache.invalidate(abs_paths)
+
+
 async def pathtype_grid(wb: websockets.client.WebSocketClientProtocol, path: str) -> str:
     if not wb: return
     if not path: return
-    result = await SendMsg(wb, 'stat', ['-nomsg', path])
+    result = await SendMsg_cached(wb, 'stat', ['-nomsg', path])
     json_dict = json.loads(result)
     error = json_dict["metadata"]["error"]
     if error:
@@ -203,16 +549,16 @@ def pathtype_local(path: str) -> str:
     return str('')
 
 
-def fileIsValid(file: str, size: Union[str, int], md5: str) -> bool:
+def fileIsValid(file: str, size: Union[str, int], md5sum: str) -> bool:
     if os.path.isfile(file):  # first check
         if int(os.stat(file).st_size) != int(size):
             os.remove(file)
             return False
-        if md5(file) != md5:
+        if md5(file) != md5sum:
             os.remove(file)
             return False
 
-        print(f"{lfn} --> TARGET VALID", flush = True)
+        print(f"{file} --> TARGET VALID", flush = True)
         return True
 
 
@@ -223,7 +569,7 @@ def create_metafile(meta_filename: str, local_filename: str, size: Union[str, in
         f.write(' <metalink xmlns="urn:ietf:params:xml:ns:metalink">\n')
         f.write("   <published>{}</published>\n".format(published))
         f.write("   <file name=\"{}\">\n".format(local_filename))
-        f.write("     <size>{}</size>\n".format(size))
+        if size: f.write("     <size>{}</size>\n".format(size))
         if md5: f.write("     <hash type=\"md5\">{}</hash>\n".format(md5))
         for url in replica_list:
             f.write("     <url><![CDATA[{}]]></url>\n".format(url))
@@ -232,6 +578,36 @@ def create_metafile(meta_filename: str, local_filename: str, size: Union[str, in
         f.closed
 
 
+def extract_zip_members(archive: str, members: list, overwrite: bool = False) -> int:
+    """Extract (member, dst, size, md5) entries from a local zip archive; return the number of members extracted and validated"""
+    import zipfile
+    import shutil
+    try:
+        zip_file = zipfile.ZipFile(archive)
+    except Exception as e:
+        print(f"Could not open archive {archive} : {e}", flush = True)
+        return int(0)
+
+    nr_extracted = int(0)
+    with zip_file:
+        for member, dst, size, md5sum in members:
+            if os.path.exists(dst) and not overwrite:
+                print(f"{dst} --> exists, use -f to overwrite", flush = True)
+                continue
+            try:
+                Path(dst).parent.mkdir(parents = True, exist_ok = True)
+                with zip_file.open(member) as f_in, open(dst, 'wb') as f_out: shutil.copyfileobj(f_in, f_out, 4194304)
+            except Exception as e:
+                print(f"{dst} --> could not extract {member} : {e}", flush = True)
+                continue
+            if int(os.path.getsize(dst)) != int(size) or (md5sum and md5(dst) != md5sum):
+                print(f"{dst} --> extracted {member} does not match the catalogue size/md5", flush = True)
+                os.remove(dst)
+                continue
+            nr_extracted += 1
+    return nr_extracted
+
+
 def md5(file: str) -> str:
     import hashlib
     BLOCKSIZE = 65536
@@ -262,6 +638,192 @@ if has_readline:
         readline.set_history_length(1000)
         readline.append_history_file(new_h_len - prev_h_len, histfile)
 
+    def setupCompleter():
+        completer = GridCompleter()
+        readline.set_completer_delims(' \t\n;|')
+        readline.set_completer(completer.complete)
+        if 'libedit' in str(readline.__doc__):
+            readline.parse_and_bind('bind ^I rl_complete')
+        else:
+            readline.parse_and_bind('tab: complete')
+        return completer
+
+
+class BackgroundLoop:
+    """An event loop running in a daemon thread; coroutines are submitted from any thread and a concurrent Future is returned"""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever, name = 'alienpy-loop', daemon = True)
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class GridCompleter:
+    """readline completion of commands and grid paths
+    The completion only looks into the cached directory listings; missing or expired listings, and the listings of the
+    subdirectories of the matches, are requested in background on a separate connection so that the completion never waits"""
+    PREFETCH_CHILDREN = 16  # maximum number of subdirectories of the matches to prefetch
+
+    def __init__(self):
+        self.listings = {}  # directory -> (timestamp, sorted entries as given by ls -F)
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.bg = None
+        self.wb = None
+        self.matches = []
+
+    def listing(self, directory: str) -> list:
+        with self.lock:
+            entry = self.listings.get(directory)
+        if entry and (time.time() - entry[0]) < CWD_LIST_TTL: return entry[1]
+        self.prefetch(directory)
+        return entry[1] if entry else None
+
+    def store(self, directory: str, entries: list):
+        with self.lock: self.listings[directory] = (time.time(), sorted(entries))
+
+    def invalidate(self, directory: str):
+        with self.lock: self.listings.pop(directory, None)
+
+    def prefetch(self, directory: str):
+        with self.lock:
+            if directory in self.in_flight: return
+            self.in_flight.add(directory)
+        if not self.bg: self.bg = BackgroundLoop()
+        self.bg.submit(self.fetch(directory))
+
+    async def fetch(self, directory: str):
+        try:
+            if not self.wb: self.wb = await AlienConnect()
+            result = await SendMsg(self.wb, 'ls', ['-nokeys', '-F', directory])
+            listing = JsonAnswer(result)
+            if not listing.metadata.get("error"): self.store(directory, [item['message'] for item in listing.results()])
+        except (Exception, SystemExit):  # AlienConnect exits when no connection is possible
+            self.wb = None
+            logging.debug(traceback.format_exc())
+        finally:
+            with self.lock: self.in_flight.discard(directory)
+
+    def complete_path(self, text: str) -> list:
+        dir_part = text[:text.rfind('/') + 1]
+        prefix = text[len(dir_part):]
+        directory = dir_part if dir_part.startswith('/') else AlienSessionInfo['currentdir'] + '/' + dir_part
+        directory = posixpath.normpath(directory) + '/'
+        if directory == '//': directory = '/'
+        entries = self.listing(directory)
+        if not entries: return []
+        idx = bisect.bisect_left(entries, prefix)
+        matches = []
+        while idx < len(entries) and entries[idx].startswith(prefix):
+            matches.append(entries[idx])
+            idx += 1
+        for subdir in [m for m in matches if m.endswith('/')][:self.PREFETCH_CHILDREN]:
+            with self.lock: known = (directory + subdir) in self.listings
+            if not known: self.prefetch(directory + subdir)
+        return [dir_part + m for m in matches]
+
+    def complete(self, text: str, state: int):
+        if state == 0:
+            line = readline.get_line_buffer()
+            if not line[:readline.get_begidx()].strip():  # first word of the command
+                commands = sorted(set(AlienSessionInfo['commandlist']).union(CMDS_CLIENT))
+                self.matches = [cmd + ' ' for cmd in commands if cmd.startswith(text)]
+            else:
+                self.matches = self.complete_path(text)
+        return self.matches[state] if state < len(self.matches) else None
+
+
+class CopyPlan:
+    """The files of a cp command, shared by all its stages (find/scan, envelopes, metalinks, transfer, commit)
+    The paths are stored column wise as the index of their interned directory and their name, the sizes and storage elements in arrays;
+    the files dropped by a stage (invalid lfn, valid local copy, archive member) are only marked in the state column;
+    the destination replicas of an upload, with their envelopes (the largest part of a plan), are spooled to a temporary file"""
+    __slots__ = ('prefixes', 'prefix_idx', 'src_dir', 'src_name', 'dst_dir', 'dst_name', 'state', 'size', 'se', 'nr_replicas', 'replica_pos', 'spool')
+    NEW, FAILED, SKIPPED, ARCHIVE = range(4)
+
+    def __init__(self):
+        self.prefixes = []  # interned directories and storage element names
+        self.prefix_idx = {}
+        self.src_dir = array('L')
+        self.src_name = []
+        self.dst_dir = array('L')
+        self.dst_name = []
+        self.state = bytearray()
+        self.size = array('q')
+        self.se = array('L')
+        self.nr_replicas = array('H')  # upload only: number of destination replicas of each file
+        self.replica_pos = array('q')  # upload only: position in spool of the replicas of each file
+        self.spool = None
+        self.intern('')
+
+    def __len__(self):
+        return len(self.state)
+
+    def intern(self, value: str) -> int:
+        idx = self.prefix_idx.get(value)
+        if idx is None:
+            idx = self.prefix_idx[value] = len(self.prefixes)
+            self.prefixes.append(value)
+        return idx
+
+    def add(self, src: str, dst: str):
+        src_dir, sep, src_name = src.rpartition('/')
+        self.src_dir.append(self.intern(src_dir + sep))
+        self.src_name.append(src_name)
+        dst_dir, sep, dst_name = dst.rpartition('/')
+        self.dst_dir.append(self.intern(dst_dir + sep))
+        self.dst_name.append(src_name if dst_name == src_name else dst_name)  # usually the same name, stored once
+        self.state.append(self.NEW)
+        self.size.append(-1)
+        self.se.append(0)
+        self.nr_replicas.append(0)
+        self.replica_pos.append(-1)
+
+    def src(self, idx: int) -> str:
+        return self.prefixes[self.src_dir[idx]] + self.src_name[idx]
+
+    def dst(self, idx: int) -> str:
+        return self.prefixes[self.dst_dir[idx]] + self.dst_name[idx]
+
+    def set_se(self, idx: int, se: str):
+        self.se[idx] = self.intern(se or '')
+
+    def get_se(self, idx: int) -> str:
+        return self.prefixes[self.se[idx]]
+
+    def count(self, *states) -> int:
+        return sum(self.state.count(state) for state in states)
+
+    def set_replicas(self, idx: int, replicas: list):
+        """Keep the (url, se, guid, envelope) of the destination replicas of an upload"""
+        if self.spool is None:
+            import tempfile
+            self.spool = tempfile.TemporaryFile(dir = os.getenv('TMPDIR', '/tmp'))
+        self.spool.seek(0, os.SEEK_END)
+        self.replica_pos[idx] = self.spool.tell()
+        self.spool.write(json.dumps(replicas).encode() + b'\n')
+        self.nr_replicas[idx] = len(replicas)
+
+    def replicas(self, idx: int) -> list:
+        if self.replica_pos[idx] < 0: return []
+        self.spool.seek(self.replica_pos[idx])
+        return [tuple(replica) for replica in json.loads(self.spool.readline())]
+
+    def close(self):
+        if self.spool: self.spool.close()
+        self.spool = None
+
+
+def token_key(token: str) -> bytes:
+    """Digest of an upload token (the envelope, about 1 KiB) to keep track of the succesful uploads in little memory"""
+    import hashlib
+    return hashlib.sha1(token.encode()).digest()
+
 
 async def ProcessXrootdCp(wb: websockets.client.WebSocketClientProtocol, xrd_copy_command: list = []) -> int:
     if not wb: return int(107)  # ENOTCONN /* Transport endpoint is not connected */
@@ -315,6 +877,9 @@ async def ProcessXrootdCp(wb: websockets.client.WebSocketClientProtocol, xrd_cop
     makedir = bool(True)  # create the parent directories when creating a file
     overwrite = bool(False)  # overwrite target if it exists
     posc = bool(True)  # persist on successful close; Files are automatically deleted should they not be successfully closed.
+    se_limit = int(os.getenv('ALIENPY_SE_MAXJOBS', '0'))  # node wide maximum of concurrent transfers per storage element; 0 is unlimited
+    rate = int(os.getenv('ALIENPY_MAXRATE', '0'))  # node wide maximum transfer rate in bytes/s; 0 is unlimited
+    prio = int(0)  # priority of this copy session when competing with other sessions for storage element slots
 
     isSrcLocal = bool(False)
     isDstLocal = bool(False)
@@ -353,6 +918,21 @@ async def ProcessXrootdCp(wb: websockets.client.WebSocketClientProtocol, xrd_cop
         batch = int(xrd_copy_command.pop(batch_idx + 1))
         xrd_copy_command.pop(batch_idx)
 
+    if '-selimit' in xrd_copy_command:
+        selimit_idx = xrd_copy_command.index('-selimit')
+        se_limit = int(xrd_copy_command.pop(selimit_idx + 1))
+        xrd_copy_command.pop(selimit_idx)
+
+    if '-ratelimit' in xrd_copy_command:
+        rate_idx = xrd_copy_command.index('-ratelimit')
+        rate = int(xrd_copy_command.pop(rate_idx + 1))
+        xrd_copy_command.pop(rate_idx)
+
+    if '-prio' in xrd_copy_command:
+        prio_idx = xrd_copy_command.index('-prio')
+        prio = int(xrd_copy_command.pop(prio_idx + 1))
+        xrd_copy_command.pop(prio_idx)
+
     if '-chunks' in xrd_copy_command:
         chunks_nr_idx = xrd_copy_command.index('-chunks')
         chunks_nr = int(xrd_copy_command.pop(chunks_nr_idx + 1))
@@ -399,10 +979,6 @@ async def ProcessXrootdCp(wb: websockets.client.WebSocketClientProtocol, xrd_cop
         pattern = xrd_copy_command.pop(select_idx + 1)
         xrd_copy_command.pop(select_idx)
 
-    # list of src files and coresponding dst names
-    src_filelist = []
-    dst_filelist = []
-
     # clean up and prepare the paths to be used in the xrdcp command
     src = ''
     src_specs_remotes = None  # let's record specifications like disk=3,SE1,!SE2
@@ -445,183 +1021,465 @@ async def ProcessXrootdCp(wb: websockets.client.WebSocketClientProtocol, xrd_cop
         return int(22)  # EINVAL /* Invalid argument */
 
     # if src is directory, then create list of files coresponding with options
+    phases = PhaseMarkers('cp')
+    plan = CopyPlan()  # list of src files and coresponding dst names
     if isDownload:
         isWrite = bool(False)
         specs = src_specs_remotes
         if isSrcDir:  # src is GRID, we are DOWNLOADING from GRID directory
-            find_args.append(src)
-            find_args.append(pattern)
-            if not DEBUG: find_args.insert(0, '-nomsg')
-            result = await SendMsg(wb, 'find', find_args)
-            src_list_files_dict = json.loads(result)
-            for file in src_list_files_dict['results']:
-                src_filelist.append(file['lfn'])
-                src_path = Path(src)
-                if parent > (len(src_path.parents) - 1): parent = len(src_path.parents) - 1  # make sure maximum parent var point to first dir in path
-                src_root = src_path.parents[parent].as_posix()
-                if src_root != '/':
-                    file_relative_name = file['lfn'].replace(src_root, '')
-                else:
-                    file_relative_name = file['lfn']
-                dst_file = dst + "/" + file_relative_name
-                dst_file = re.sub(r"\/{2,}", "/", dst_file)
-                dst_filelist.append(dst_file)
+            phases.mark('find')
+            src_path = Path(src)
+            if parent > (len(src_path.parents) - 1): parent = len(src_path.parents) - 1  # make sure maximum parent var point to first dir in path
+            src_root = src_path.parents[parent].as_posix()
+            try:
+                async for file in find_sharded(wb, src, pattern, find_args):
+                    file_relative_name = file['lfn'].replace(src_root, '') if src_root != '/' else file['lfn']
+                    plan.add(file['lfn'], RE_MULTI_SLASH.sub('/', dst + "/" + file_relative_name))
+            except OSError as e:  # an incomplete list of files is not copied
+                print(f"Could not list {e.filename}: {e.strerror}", flush = True)
+                plan.close()
+                return int(e.errno)
         else:
-            src_filelist.append(src)
             if dst.endswith("/"): dst = dst[:-1] + setDst(src, parent)
-            dst_filelist.append(dst)
+            plan.add(src, dst)
     else:  # it is upload
         isWrite = bool(True)
         specs = dst_specs_remotes
         if isSrcDir:  # src is LOCAL, we are UPLOADING from LOCAL directory
+            phases.mark('scan')
             regex = re.compile(pattern)
-            list = []
+            src_path = Path(src)
+            if parent > (len(src_path.parents) - 1): parent = len(src_path.parents) - 1  # make sure maximum parent var point to first dir in path
+            src_root = src_path.parents[parent].as_posix()
             for root, dirs, files in os.walk(src[:-1]):
                 for file in files:
                     filepath = os.path.join(root, file)
-                    if regex.match(filepath):
-                        src_filelist.append(filepath)
-                        src_path = Path(src)
-                        if parent > (len(src_path.parents) - 1): parent = len(src_path.parents) - 1  # make sure maximum parent var point to first dir in path
-                        src_root = src_path.parents[parent].as_posix()
-                        if src_root != '/':
-                            file_relative_name = filepath.replace(src_root, '')
-                        else:
-                            file_relative_name = filepath
-                        dst_file = dst[:-1] + "/" + file_relative_name
-                        dst_file = re.sub(r"\/{2,}", "/", dst_file)
-                        dst_filelist.append(dst_file)
+                    if not regex.match(filepath): continue
+                    file_relative_name = filepath.replace(src_root, '') if src_root != '/' else filepath
+                    plan.add(filepath, RE_MULTI_SLASH.sub('/', dst[:-1] + "/" + file_relative_name))
         else:
-            src_filelist.append(src)
             if dst.endswith("/"): dst = dst[:-1] + setDst(src, parent)
-            dst_filelist.append(dst)
+            plan.add(src, dst)
 
     if XRDDEBUG:
         logging.debug("We are going to copy these files:")
-        for src_dbg, dst_dbg in zip(src_filelist, dst_filelist):
-            logging.debug(f"src: {src_dbg}\ndst: {dst_dbg}\n")
-
-    lfn_list = []
-    if isDownload:
-        lfn_list = src_filelist
-    else:
-        lfn_list = dst_filelist
-
-    envelope_list = await getEnvelope(wb, lfn_list, specs, isWrite)
-
-    # print errors
-    errors_idx = []
-    for item_idx, item in enumerate(envelope_list):
-        lfn = item["lfn"]
-        result = item["answer"]
+        for file_idx in range(len(plan)):
+            logging.debug(f"src: {plan.src(file_idx)}\ndst: {plan.dst(file_idx)}\n")
+
+    def meta_fn(lfn: str) -> str:
+        return tmpdir + "/" + lfn.replace("/", "%%") + ".meta4"
+
+    # the envelopes are requested pipelined and each answer is used as it arrives, the answers are not kept
+    phases.mark('envelopes')
+    lfn_of = plan.src if isDownload else plan.dst
+    envelope_idx = deque()
+
+    def access_cmds():
+        for file_idx in range(len(plan)):
+            envelope_idx.append(file_idx)
+            yield 'access', envelope_args(lfn_of(file_idx), specs, isWrite)
+
+    archives = {}  # members requested from the same archive; key is the list of archive replicas
+    async for result in SendMsg_pipelined(wb, access_cmds(), 16):
+        file_idx = envelope_idx.popleft()
+        lfn = lfn_of(file_idx)
         access_request = json.loads(result)
         if access_request["metadata"]["error"]:
-            errors_idx.append(item_idx)
+            plan.state[file_idx] = CopyPlan.FAILED
             error = access_request["metadata"]["error"]
             print(f"lfn: {lfn} --> {error}", flush = True)
+            continue
         if XRDDEBUG:
             logging.debug(lfn)
             logging.debug(json.dumps(access_request, sort_keys=True, indent=4))
 
-    for i in reversed(errors_idx): envelope_list.pop(i)  # remove from list invalid lfns
-    if not envelope_list:
+        if not isDownload:
+            plan.size[file_idx] = os.path.getsize(plan.src(file_idx))
+            plan.set_replicas(file_idx, [(server['url'], server.get('se', ''), server.get('guid', ''), server['envelope']) for server in access_request['results'] if server])
+            continue
+
+        if not access_request['results']:
+            plan.state[file_idx] = CopyPlan.SKIPPED
+            continue
+        dst = plan.dst(file_idx)
+        size_4meta = access_request['results'][0]['size']  # size SHOULD be the same for all replicas
+        md5_4meta = access_request['results'][0]['md5']  # the md5 hash SHOULD be the same for all replicas
+
+        # ALWAYS check if exist and valid. There is no scenario where the download is required even if the md5sums match
+        if fileIsValid(dst, size_4meta, md5_4meta):
+            plan.state[file_idx] = CopyPlan.SKIPPED
+            continue
+
+        # multiple replicas are downloaded to a single file
+        is_zip = False
+        file_in_zip = ''
+        url_list_4meta = []
+        archive_replicas = []
+        for server in access_request['results']:
+            url_components = server['url'].rsplit('#', maxsplit = 1)
+            if len(url_components) > 1:
+                is_zip = True
+                file_in_zip = url_components[1]
+            complete_url = url_components[0] + '?authz=' + server['envelope']
+            url_list_4meta.append(complete_url)
+            archive_replicas.append(url_components[0])
+
+        plan.size[file_idx] = int(size_4meta)
+        plan.set_se(file_idx, access_request['results'][0].get('se', ''))  # the scheduler accounts the job to the first replica
+        if is_zip:  # defer the decision: more members of the same archive means a single download of the archive
+            plan.state[file_idx] = CopyPlan.ARCHIVE
+            archive = archives.setdefault(tuple(sorted(archive_replicas)), {'urls': url_list_4meta, 'se': plan.get_se(file_idx), 'lfn': lfn, 'members': []})
+            archive['members'].append((file_in_zip, dst, size_4meta, md5_4meta))
+            continue
+        create_metafile(meta_fn(lfn), dst, size_4meta, md5_4meta, url_list_4meta)
+
+    if plan.count(CopyPlan.FAILED) == len(plan):
         print("No lfns in envelope list after removing the invalid ones")
         return int(2)  # ENOENT /* No such file or directory */
 
-    url_list_src = []
-    url_list_dst = []
+    phases.mark('metalinks')
+    archive_jobs = []  # (src url, dst url, se, size) like the jobs of the plan
+    for archive in archives.values():
+        if len(archive['members']) == 1:  # a single member is read directly from the remote archive
+            file_in_zip, dst, size_4meta, md5_4meta = archive['members'][0]
+            create_metafile(meta_fn(archive['lfn']), dst, size_4meta, md5_4meta, archive['urls'])
+            archive_jobs.append((meta_fn(archive['lfn']) + '?xrdcl.unzip=' + file_in_zip, dst, archive['se'], int(size_4meta)))
+            continue
+        # the whole archive is downloaded once and the members are extracted locally after the copy
+        archive['tmp'] = make_tmp_fn()
+        create_metafile(meta_fn(archive['lfn']), archive['tmp'], '', '', archive['urls'])
+        archive_jobs.append((meta_fn(archive['lfn']), archive['tmp'], archive['se'], sum(int(member[2]) for member in archive['members'])))
+
+    def copy_jobs():
+        """The copy jobs as (src url, dst url, se, size), generated from the plan when the copy process asks for them"""
+        for file_idx in range(len(plan)):
+            if plan.state[file_idx] != CopyPlan.NEW: continue
+            if isDownload:
+                yield meta_fn(plan.src(file_idx)), plan.dst(file_idx), plan.get_se(file_idx), plan.size[file_idx]
+                continue
+            src = plan.src(file_idx)
+            for url, se, guid, envelope in plan.replicas(file_idx):
+                yield src, url + "?authz=" + envelope, se, plan.size[file_idx]
+        yield from archive_jobs
+
     if isDownload:
-        for item_idx, item in enumerate(envelope_list):
-            lfn = item["lfn"]
-            result = item["answer"]
-            access_request = json.loads(result)
-            if not access_request['results']: continue
-
-            dst = dst_filelist[item_idx]
-            size_4meta = access_request['results'][0]['size']  # size SHOULD be the same for all replicas
-            md5_4meta = access_request['results'][0]['md5']  # the md5 hash SHOULD be the same for all replicas
-
-            # ALWAYS check if exist and valid. There is no scenario where the download is required even if the md5sums match
-            if fileIsValid(dst, size_4meta, md5_4meta): continue
-
-            # multiple replicas are downloaded to a single file
-            is_zip = False
-            file_in_zip = ''
-            url_list_4meta = []
-            for server in access_request['results']:
-                url_components = server['url'].rsplit('#', maxsplit = 1)
-                if len(url_components) > 1:
-                    is_zip = True
-                    file_in_zip = url_components[1]
-                complete_url = url_components[0] + '?authz=' + server['envelope']
-                url_list_4meta.append(complete_url)
-
-            url_list_dst.append({"url": dst})  # the local file destination
-            src = src_filelist[item_idx]
-            meta_fn = tmpdir + "/" + src.replace("/", "%%") + ".meta4"
-            create_metafile(meta_fn, dst, size_4meta, md5_4meta, url_list_4meta)
-            if is_zip:
-                download_link = meta_fn + '?xrdcl.unzip=' + file_in_zip
-            else:
-                download_link = meta_fn
-            url_list_src.append({"url": download_link})
+        nr_jobs = plan.count(CopyPlan.NEW) + len(archive_jobs)
     else:
-        for item_idx, item in enumerate(envelope_list):
-            src = src_filelist[item_idx]
-            lfn = item["lfn"]
-            result = item["answer"]
-            access_request = json.loads(result)
-            for server in access_request['results']:
-                if not server: continue
-                complete_url = server['url'] + "?" + "authz=" + server['envelope']
-                url_list_dst.append({"url": complete_url})
-                url_list_src.append({"url": src})
-
-    if not (url_list_src or url_list_dst):
+        nr_jobs = sum(plan.nr_replicas)
+    if not nr_jobs:
         if XRDDEBUG: logging.debug("copy src/dst lists are empty, no copy process to be started")
         return int(2)  # ENOENT /* No such file or directory */
 
     if XRDDEBUG:
         logging.debug("List of files:")
-        for src_dbg, dst_dbg in zip(url_list_src, url_list_dst):
-            logging.debug("src:{0}\ndst:{1}\n".format(src_dbg['url'], dst_dbg['url']))
+        for src_dbg, dst_dbg, se_dbg, size_dbg in copy_jobs():
+            logging.debug("src:{0}\ndst:{1}\n".format(src_dbg, dst_dbg))
 
-    my_cp_args = XrdCpArgs(overwrite, batch, sources, chunks, chunksize, makedir, posc, hashtype, streams)
+    phases.mark('transfer')
+    my_cp_args = XrdCpArgs(overwrite, batch, sources, chunks, chunksize, makedir, posc, hashtype, streams, se_limit, rate, prio)
     # defer the list of url and files to xrootd processing - actual XRootD copy takes place
-    token_list_upload_ok = XrdCopy(url_list_src, url_list_dst, isDownload, my_cp_args)
-
+    # in a thread, the event loop stays free for the other requests and the keepalive of the connections
+    token_list_upload_ok = await asyncio.get_event_loop().run_in_executor(None, XrdCopy, copy_jobs(), isDownload, my_cp_args, nr_jobs)
+
+    nr_ok = len(token_list_upload_ok) if token_list_upload_ok else int(0)
+    downloads_ok = set(token_list_upload_ok) if isDownload and archives else set()
+    for archive in archives.values():
+        if 'tmp' not in archive: continue
+        if meta_fn(archive['lfn']) in downloads_ok: nr_ok -= 1  # a whole archive counts as its members extracted, not as one file
+        if os.path.isfile(archive['tmp']):
+            nr_extracted = extract_zip_members(archive['tmp'], archive['members'], overwrite)
+            print(f"{archive['lfn']} --> {nr_extracted}/{len(archive['members'])} members extracted from archive", flush = True)
+            os.remove(archive['tmp'])
+            nr_ok += nr_extracted
+
+    phases.mark('commit' if (not isDownload) and token_list_upload_ok else None)
     if (not isDownload) and token_list_upload_ok:  # it was an upload job that had succesfull uploads
-        for item_idx, item in enumerate(envelope_list):
-            result = item["answer"]
-            access_request = json.loads(result)
-            src = src_filelist[item_idx]
-            dst = dst_filelist[item_idx]
+        cwd_list_invalidate()
+        metacache_invalidate(plan.dst(file_idx) for file_idx in range(len(plan)))
+        tokens_ok = set(token_list_upload_ok)
+        for file_idx in range(len(plan)):
+            if not plan.nr_replicas[file_idx]: continue
+            uploaded = [(url_authz(url + "?authz=" + envelope), url, se, guid) for url, se, guid, envelope in plan.replicas(file_idx)]
+            uploaded = [replica for replica in uploaded if token_key(replica[0]) in tokens_ok]  # the replicas with succesful uploaded token
+            if not uploaded: continue
             # common values for all commit commands
-            lfn = dst
-            size = os.path.getsize(src)
+            src = plan.src(file_idx)
+            lfn = plan.dst(file_idx)
+            size = plan.size[file_idx]
             md5sum = md5(src)
             perm = '644'
             expire = '0'
-            for token in token_list_upload_ok:  # for each succesful token
-                for server in access_request['results']:  # go over all received servers
-                    if token in server['envelope']:  # for the server that have the succesful uploaded token
-                        pfn = server['url']
-                        se = server['se']
-                        guid = server['guid']
-                        # envelope size lfn perm expire pfn se guid md5
-                        commit_args_list = [token, int(size), lfn, perm, expire, pfn, se, guid, md5sum]
-                        commit_results = await SendMsg(wb, 'commit', commit_args_list)
-                        if XRDDEBUG: logging.debug(json.dumps(json.loads(commit_results), sort_keys=True, indent=4))
+            for token, pfn, se, guid in uploaded:
+                # envelope size lfn perm expire pfn se guid md5
+                commit_args_list = [token, int(size), lfn, perm, expire, pfn, se, guid, md5sum]
+                commit_results = await SendMsg(wb, 'commit', commit_args_list)
+                if XRDDEBUG: logging.debug(json.dumps(json.loads(commit_results), sort_keys=True, indent=4))
+    phases.mark()
+    plan.close()
 
     # hard to return a single exitcode for a copy process optionally spanning multiple files
     # we'll return SUCCESS if at least one lfn is confirmed, FAIL if not lfns is confirmed
-    if token_list_upload_ok:
+    if nr_ok > 0:
         return int(0)
     else:
         return int(1)
 
 
-def XrdCopy(src: list, dst: list, isDownload: bool, xrd_cp_args: XrdCpArgs) -> list:
+def pid_alive(pid: Union[str, int]) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class TransferScheduler:
+    """Admission of copy jobs shared by all alien.py processes of the user on this node
+    It enforces a maximum of concurrent jobs per storage element, a byte-rate cap and priorities between copy sessions;
+    the shared state is a json file in TMPDIR guarded by flock, entries of dead processes are dropped"""
+    def __init__(self, se_limit: int = 0, rate: int = 0, prio: int = 0):
+        self.se_limit = int(se_limit)
+        self.rate = int(rate)
+        self.prio = int(prio)
+        self.pid = str(os.getpid())
+        state_base = os.getenv('TMPDIR', '/tmp') + '/alienpy_xfer_' + str(os.getuid())
+        self.state_file = state_base + '.json'
+        self.lock_file = state_base + '.lock'
+
+    def _update(self, action):
+        """Run action(state) under the node wide lock and save the modified state"""
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.state_file) as f: state = json.load(f)
+                except Exception:
+                    state = {}
+                sessions = state.setdefault('sessions', {})
+                for pid in list(sessions):
+                    if not pid_alive(pid): sessions.pop(pid)
+                result = action(state)
+                state_tmp = self.state_file + '.' + self.pid
+                with open(state_tmp, 'w') as f: json.dump(state, f)
+                os.replace(state_tmp, self.state_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return result
+
+    @staticmethod
+    def job_se(job: tuple) -> str:
+        return job[2] or ''
+
+    def acquire(self, jobs: list, max_jobs: int) -> list:
+        """Return the jobs (at most max_jobs) that can be started now; the SE slots are reserved for this process"""
+        def action(state):
+            sessions = state['sessions']
+            me = sessions.setdefault(self.pid, {'prio': self.prio, 'se': {}, 'want': []})
+            se_busy = {}
+            for session in sessions.values():
+                for se, nr in session['se'].items(): se_busy[se] = se_busy.get(se, 0) + nr
+            se_reserved = set()  # SEs on which a waiting session with higher priority has precedence
+            for pid, session in sessions.items():
+                if pid != self.pid and session['prio'] > self.prio: se_reserved.update(session['want'])
+            granted = []
+            for job in jobs:
+                if len(granted) >= max(int(max_jobs), 1): break
+                se = self.job_se(job)
+                if se in se_reserved: continue
+                if self.se_limit > 0 and se_busy.get(se, 0) >= self.se_limit: continue
+                se_busy[se] = se_busy.get(se, 0) + 1
+                me['se'][se] = me['se'].get(se, 0) + 1
+                granted.append(job)
+            me['want'] = [] if granted else sorted(set(self.job_se(job) for job in jobs))
+            return granted
+        return self._update(action)
+
+    def release(self, jobs: list):
+        def action(state):
+            me = state['sessions'].get(self.pid)
+            if not me: return
+            for job in jobs:
+                se = self.job_se(job)
+                me['se'][se] = me['se'].get(se, 0) - 1
+                if me['se'][se] < 1: me['se'].pop(se)
+        self._update(action)
+
+    def throttle(self, nbytes: int) -> float:
+        """Account nbytes to the node wide token bucket and return the seconds to wait before starting the transfer"""
+        if self.rate < 1: return float(0)
+
+        def action(state):
+            now = time.time()
+            bucket = state.setdefault('bucket', {'ts': now, 'tokens': float(self.rate)})
+            tokens = min(float(self.rate), bucket['tokens'] + (now - bucket['ts']) * self.rate)  # burst of at most 1s worth of transfer
+            delay = -tokens / self.rate if tokens < 0 else float(0)  # previous debt must be paid before starting
+            bucket['tokens'] = tokens - nbytes
+            bucket['ts'] = now
+            return delay
+        return self._update(action)
+
+    def close(self):
+        self._update(lambda state: state['sessions'].pop(self.pid, None))
+
+
+class WbPipeline:
+    """Requests of any number of coroutines in flight on one connection, at most window at a time
+    The server answers the messages of a connection in the order they were received, so the answers are matched in FIFO order;
+    while a pipeline has requests in flight the connection must not be used directly"""
+    def __init__(self, wb: websockets.client.WebSocketClientProtocol, window: int = 32):
+        self.wb = wb
+        self.slots = asyncio.Semaphore(max(int(window), 1))
+        self.send_lock = asyncio.Lock()
+        self.waiting = deque()
+        self.reader = None
+
+    async def request(self, cmd: str, args: list = []) -> str:
+        async with self.slots:
+            replayed = False
+            while True:
+                generation = getattr(self.wb, 'generation', 0)
+                answer = asyncio.get_event_loop().create_future()
+                sent = False
+                begin = time.time()
+                try:
+                    async with self.send_lock:  # the order of sending is the order of waiting
+                        await self.wb.send(CreateJsonCommand(cmd, args))
+                        sent = True
+                        self.waiting.append(answer)
+                    if not self.reader: self.reader = asyncio.ensure_future(self.read_answers())
+                    result = await answer
+                    stats.record('rtt ' + cmd, time.time() - begin, len(result))
+                    return result
+                except (websockets.exceptions.ConnectionClosed, OSError) as e:
+                    stats.record('rtt ' + cmd, time.time() - begin, error = True)
+                    if not isinstance(self.wb, AlienWebSocket): raise
+                    if not await self.wb.reconnect(generation): return answer_not_connected(cmd)
+                    if replayed or (sent and (ws_close_permanent(e) or not cmd_replayable(cmd, args))): return answer_not_connected(cmd, e)
+                    replayed = True
+
+    async def read_answers(self):
+        try:
+            while self.waiting:
+                result = await self.wb.recv()
+                answer = self.waiting.popleft()
+                if not answer.cancelled(): answer.set_result(result)
+        except Exception as e:
+            while self.waiting:
+                answer = self.waiting.popleft()
+                if not answer.cancelled(): answer.set_exception(e)
+        finally:
+            self.reader = None
+
+
+def find_page_error(metadata: dict) -> tuple:
+    """(exitcode, error) of a failed find page (server error, timeout, lost connection), None for a succesful one"""
+    exitcode = int(metadata.get('exitcode', 0))
+    error = metadata.get('error', '')
+    if exitcode == 0 and not error: return None
+    return exitcode or 1, error
+
+
+def find_pages(pipeline: WbPipeline, find_args: list, directory: str, pattern: str, page_size: int = FIND_PAGESIZE):
+    """Answers of find requested in pages with -l/-o; the -l/-o of find_args are the overall limit and offset
+    The page size adapts to the observed answer time and the next page is requested before the current one is consumed.
+    A failed page is the last one yielded, only a succesful short page ends the listing.
+    With -x (the result is written to a collection) a single find is done"""
+    find_opts = list(find_args)
+    offset = int(0)
+    limit = int(-1)
+    if '-o' in find_opts:
+        offset_idx = find_opts.index('-o')
+        offset = int(find_opts.pop(offset_idx + 1))
+        find_opts.pop(offset_idx)
+    if '-l' in find_opts:
+        limit_idx = find_opts.index('-l')
+        limit = int(find_opts.pop(limit_idx + 1))
+        find_opts.pop(limit_idx)
+
+    async def timed_request(args: list) -> tuple:
+        begin = time.time()
+        answer = await pipeline.request('find', args)
+        return answer, time.time() - begin
+
+    def request_page(page_offset: int, page_limit: int) -> asyncio.Future:
+        return asyncio.ensure_future(timed_request(find_opts + ['-l', str(page_limit), '-o', str(page_offset), directory, pattern]))
+
+    async def pages(page: asyncio.Future, requested: int):
+        nonlocal offset, limit, page_size
+        while True:
+            answer, answer_time = await page
+            page_answer = JsonAnswer(answer)
+            failed = find_page_error(page_answer.metadata) is not None
+            nr_results = page_answer.count() if requested and not failed else int(0)
+            offset += nr_results
+            if limit > 0: limit -= nr_results
+            more = requested and not failed and nr_results >= requested and limit != 0
+            if more:
+                if answer_time < FIND_PAGE_TIME / 4: page_size = min(page_size * 2, FIND_PAGESIZE_MAX)
+                elif answer_time > FIND_PAGE_TIME: page_size = max(page_size // 2, FIND_PAGESIZE_MIN)
+                requested = page_size if limit < 0 else min(page_size, limit)
+                page = request_page(offset, requested)
+            yield answer
+            if not more: return
+
+    if page_size < 1 or '-x' in find_opts:  # pagination disabled, a single find with the original arguments
+        return pages(asyncio.ensure_future(timed_request(list(find_args) + [directory, pattern])), 0)
+    requested = page_size if limit < 0 else min(page_size, limit)
+    return pages(request_page(offset, requested), requested)
+
+
+def find_paginated(pipeline: WbPipeline, find_args: list, directory: str, pattern: str):
+    """The entries found by the paginated find, as the pages arrive; the first page is requested right away.
+    A failed page raises OSError with the exitcode and the error of the answer"""
+    answers = find_pages(pipeline, find_args, directory, pattern)
+
+    async def files():
+        async for answer in answers:
+            page = JsonAnswer(answer)
+            error = find_page_error(page.metadata)
+            if error: raise OSError(*error, directory)
+            for file in page.results(): yield file
+    return files()
+
+
+async def find_sharded(wb: websockets.client.WebSocketClientProtocol, directory: str, pattern: str = '.*', find_args: list = [], window: int = 8):
+    """Recursive find of pattern in directory, done as one paginated find per top level subdirectory with the requests pipelined;
+    the found entries are yielded as the answers arrive, merged in the name order of the top level entries.
+    Top level files can be taken from the listing only if they need no filtering, otherwise a single paginated find is done,
+    as for a global limit/offset or when the listing fails (e.g. answer over the size limit) or is larger than a find page"""
+    nomsg = [] if DEBUG else ['-nomsg']
+    if '-l' in find_args or '-o' in find_args:
+        entries = None
+    else:
+        result = await SendMsg(wb, 'ls', ['-nokeys', '-F'] + (['-a'] if '-a' in find_args else []) + [directory])
+        listing = JsonAnswer(result)
+        if listing.metadata.get("error") or (FIND_PAGESIZE > 0 and listing.count() > FIND_PAGESIZE):
+            entries = None  # a flat directory with many files is found page by page, with bounded answers
+        else:
+            entries = sorted(item['message'] for item in listing.results() if item['message'] not in ('./', '../'))
+        if entries is not None and any(not e.endswith('/') for e in entries) and ('-j' in find_args or pattern not in ('.', '.*', '*')): entries = None
+
+    pipeline = WbPipeline(wb, window)
+    if entries is None:
+        async for file in find_paginated(pipeline, nomsg + find_args, directory, pattern): yield file
+        return
+
+    directory = directory.rstrip('/') + '/'
+    subdirs = deque(e for e in entries if e.endswith('/'))
+    shards = deque()  # the finds of the next subdirectories are started ahead
+    for entry in entries:
+        if not entry.endswith('/'):
+            yield {'lfn': directory + entry}
+            continue
+        while subdirs and len(shards) < window: shards.append(find_paginated(pipeline, nomsg + find_args, directory + subdirs.popleft(), pattern))
+        async for file in shards.popleft(): yield file
+
+
+def XrdCopy(jobs, isDownload: bool, xrd_cp_args: XrdCpArgs, nr_jobs: int = 0) -> list:
+    """Run the copy jobs, an iterable of (src url, dst url, se, size); return the succesful metalinks (download) or token_key of the tokens (upload)
+    nr_jobs, if known, is the total shown in the progress messages"""
     if not xrd_cp_args: return
     from XRootD import client
 
@@ -634,6 +1492,9 @@ def XrdCopy(src: list, dst: list, isDownload: bool, xrd_cp_args: XrdCpArgs) -> l
     posc = xrd_cp_args.posc
     hashtype = xrd_cp_args.hashtype
     streams = xrd_cp_args.streams
+    se_limit = xrd_cp_args.se_limit
+    rate = xrd_cp_args.rate
+    prio = xrd_cp_args.prio
 
     class MyCopyProgressHandler(client.utils.CopyProgressHandler):
         isDownload = bool(True)
@@ -644,18 +1505,21 @@ def XrdCopy(src: list, dst: list, isDownload: bool, xrd_cp_args: XrdCpArgs) -> l
         total = None
         jobs = None
         job_list = []
+        job_nr = None  # number of the job in the whole copy when each copy process runs a single job
 
         def begin(self, id, total, source, target):
             self.timestamp_begin = datetime.now().timestamp()
-            print("jobID: {0}/{1} >>> Start".format(id, total), flush = True)
+            if self.job_nr: id = self.job_nr
+            self.jobs = int(nr_jobs or total)
+            print("jobID: {0}/{1} >>> Start".format(id, self.jobs), flush = True)
             self.src = source
             self.dst = target
-            self.jobs = int(total)
             self.job_list.append(id)
             if XRDDEBUG:
                 logging.debug("CopyProgressHandler.src: {0}\nCopyProgressHandler.dst: {1}\n".format(self.src, self.dst))
 
         def end(self, jobId, results):
+            if self.job_nr: jobId = self.job_nr
             results_message = results['status'].message
             results_status = results['status'].status
             results_errno = results['status'].errno
@@ -664,6 +1528,7 @@ def XrdCopy(src: list, dst: list, isDownload: bool, xrd_cp_args: XrdCpArgs) -> l
             if results['status'].ok: status = 'OK'
             if results['status'].error: status = 'ERROR'
             if results['status'].fatal: status = 'FATAL'
+            stats.record('xrootd transfer', datetime.now().timestamp() - self.timestamp_begin, self.total or 0, error = not results['status'].ok)
 
             if results['status'].ok:
                 deltaT = datetime.now().timestamp() - self.timestamp_begin
@@ -683,9 +1548,7 @@ def XrdCopy(src: list, dst: list, isDownload: bool, xrd_cp_args: XrdCpArgs) -> l
                     os.remove(urlparse(str(self.src)).path)  # remove the created metalink
                     self.token_list_upload_ok.append(str(self.src))
                 else:  # isUpload
-                    link = urlparse(str(self.dst))
-                    token = next((param for param in str.split(link.query, '&') if 'authz=' in param), None).replace('authz=', '')  # extract the token from url
-                    self.token_list_upload_ok.append(str(token))
+                    self.token_list_upload_ok.append(token_key(url_authz(str(self.dst))))  # extract the token from url
             else:
                 print("jobID: {0}/{1} >>> STATUS: {2} ; ERRNO: {3} ; CODE: {4} ; MESSAGE: {5}".format(jobId, self.jobs, results_status, results_errno, results_code, results_message), flush = True)
 
@@ -694,28 +1557,89 @@ def XrdCopy(src: list, dst: list, isDownload: bool, xrd_cp_args: XrdCpArgs) -> l
             # perc = float(processed)/float(total)
             # print("jobID: {0}/{1} >>> Completion = {2:.2f}".format(jobId, self.jobs, perc), flush = True)
 
-    process = client.CopyProcess()
     handler = MyCopyProgressHandler()
-    process.parallel(int(batch))
     if streams > 0:
         if streams > 15: streams = 15
         client.EnvPutInt('SubStreamsPerChannel', streams)
 
     handler.isDownload = isDownload
-    for url_src, url_dst in zip(src, dst):
-        if XRDDEBUG: logging.debug("\nadd copy job with\nsrc: {0}\ndst: {1}\n".format(url_src['url'], url_dst['url']))
-        process.add_job(url_src["url"], url_dst["url"],
-                        sourcelimit = sources,
-                        force = overwrite,
-                        posc = posc,
-                        mkdir = makedir,
-                        chunksize = chunksize,
-                        parallelchunks = chunks
-                        )
-    process.prepare()
-    process.run(handler)
-    return handler.token_list_upload_ok  # for upload jobs we must return the list of token for succesful uploads
 
+    def run_jobs(job_list, handler = handler):
+        process = client.CopyProcess()
+        process.parallel(int(batch))
+        for url_src, url_dst, se, size in job_list:
+            if XRDDEBUG: logging.debug("\nadd copy job with\nsrc: {0}\ndst: {1}\n".format(url_src, url_dst))
+            process.add_job(url_src, url_dst,
+                            sourcelimit = sources,
+                            force = overwrite,
+                            posc = posc,
+                            mkdir = makedir,
+                            chunksize = chunksize,
+                            parallelchunks = chunks
+                            )
+        process.prepare()
+        process.run(handler)
+
+    if se_limit < 1 and rate < 1:  # no limits, all jobs go to a single copy process
+        run_jobs(jobs)
+        return handler.token_list_upload_ok  # for upload jobs we must return the list of token for succesful uploads
+
+    # with limits in place a pool of <batch> workers runs one job at a time each: a job is admitted by the node wide scheduler
+    # when a slot of its SE is free and the slot is released as soon as it ends, so a slow transfer holds only its own slot
+    scheduler = TransferScheduler(se_limit, rate, prio)
+    jobs = iter(jobs)
+    pending = {}  # SE -> deque of the jobs read ahead from jobs and waiting for admission, in order
+    read_ahead = max(int(batch), 1) * 64  # jobs of other SEs are looked for this far ahead when the SE of the next one is full
+    admission = threading.Lock()
+    counters = {'pending': 0, 'started': 0, 'exhausted': False}
+
+    def next_job():
+        """The next job admitted by the scheduler, None when all jobs were started, False when none can be started now"""
+        with admission:
+            while not counters['exhausted'] and counters['pending'] < read_ahead:
+                job = next(jobs, None)
+                if job is None:
+                    counters['exhausted'] = True
+                    break
+                pending.setdefault(TransferScheduler.job_se(job), deque()).append(job)
+                counters['pending'] += 1
+            if not counters['pending']: return None
+            granted = scheduler.acquire([queue[0] for queue in pending.values()], 1)  # only the first job of each SE is a candidate
+            if not granted: return False
+            se = TransferScheduler.job_se(granted[0])
+            pending[se].popleft()
+            if not pending[se]: pending.pop(se)
+            counters['pending'] -= 1
+            counters['started'] += 1
+            return counters['started'], granted[0]
+
+    def worker():
+        my_handler = MyCopyProgressHandler()  # the handler keeps the state of the job in progress, one per worker
+        my_handler.isDownload = isDownload
+        my_handler.token_list_upload_ok = handler.token_list_upload_ok
+        while True:
+            admitted = next_job()
+            if admitted is None: return
+            if admitted is False:
+                time.sleep(1)
+                continue
+            my_handler.job_nr, job = admitted
+            try:
+                delay = scheduler.throttle(max(int(job[3]), 0))
+                if delay > 0:
+                    if XRDDEBUG: logging.debug(f"rate limit: delaying job {my_handler.job_nr} for {delay:.2f}s")
+                    time.sleep(delay)
+                run_jobs([job], my_handler)
+            finally:
+                scheduler.release([job])
+
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        with ThreadPoolExecutor(max_workers = max(int(batch), 1)) as pool:
+            for worker_done in [pool.submit(worker) for i in range(max(int(batch), 1))]: worker_done.result()
+    finally:
+        scheduler.close()
+    return handler.token_list_upload_ok  # for upload jobs we must return the list of token for succesful uploads
 
 def make_tmp_fn(lfn = ''):
     ext = '_' + str(os.getuid()) + '.alienpy_tmp'
@@ -724,11 +1648,117 @@ def make_tmp_fn(lfn = ''):
     return os.getenv('TMPDIR', '/tmp') + '/' + lfn.replace("/", '%%') + ext
 
 
+def cache_fn(lfn: str) -> str:
+    return CACHE_CONTENT + '/' + lfn.replace("/", '%%')
+
+
+def cache_lock():
+    """Exclusive lock of the cache directory, to be used as context manager"""
+    Path(CACHE_CONTENT).mkdir(parents = True, exist_ok = True)
+    lock = open(CACHE_CONTENT + '/.lock', 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+async def cache_get(wb: websockets.client.WebSocketClientProtocol, lfn: str) -> str:
+    """Return the cached copy of lfn if it still matches the catalogue size and md5"""
+    if CACHE_SIZE < 1: return ''
+    cached = cache_fn(lfn)
+    try:
+        with open(cached + '.meta') as f: meta = json.load(f)
+    except Exception:
+        return ''
+    result = await SendMsg(wb, 'stat', ['-nomsg', lfn])
+    json_dict = json.loads(result)
+    stat_info = json_dict['results'][0] if json_dict['results'] else {}
+    if json_dict["metadata"]["error"] or str(stat_info.get('size')) != str(meta['size']) or stat_info.get('md5') != meta['md5'] or not os.path.isfile(cached):
+        try:
+            with cache_lock():
+                for f in (cached, cached + '.meta'):
+                    if os.path.isfile(f): os.remove(f)
+        except OSError:
+            logging.debug(traceback.format_exc())
+        return ''
+    try:
+        os.utime(cached)  # the modification time is the last use of the entry
+    except OSError:  # evicted meanwhile by another process
+        return ''
+    return cached
+
+
+def cache_put(lfn: str, file: str):
+    """Store a copy of file as the content of lfn and evict the least recently used entries above the size limit
+    The cache is optional: when it cannot be written (no or read-only home) the file is just not cached"""
+    if CACHE_SIZE < 1: return
+    try:
+        cache_store(lfn, file)
+    except OSError as e:
+        logging.debug(f"{lfn} not cached: {e}")
+        cached_tmp = cache_fn(lfn) + '.' + str(os.getpid())
+        for f in (cached_tmp, cached_tmp + '.meta'):
+            if os.path.isfile(f): os.remove(f)
+
+
+def cache_store(lfn: str, file: str):
+    import shutil
+    size = os.path.getsize(file)
+    if size > CACHE_SIZE: return
+    cached = cache_fn(lfn)
+    cached_tmp = cached + '.' + str(os.getpid())
+    with cache_lock():
+        shutil.copyfile(file, cached_tmp)
+        with open(cached_tmp + '.meta', 'w') as f: json.dump({'lfn': lfn, 'size': size, 'md5': md5(file)}, f)
+        os.replace(cached_tmp, cached)
+        os.replace(cached_tmp + '.meta', cached + '.meta')
+
+        entries = []
+        for entry in os.scandir(CACHE_CONTENT):
+            if not entry.name.endswith('.meta'): continue  # only the files with a .meta are entries of the cache
+            path = entry.path[:-len('.meta')]
+            try:
+                entry_stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, path))
+        total_size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if total_size <= CACHE_SIZE: break
+            for f in (path, path + '.meta'):
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+            total_size -= entry_size
+
+
 async def download_tmp(wb, lfn):
-    tmpfile = make_tmp_fn(expand_path_grid(lfn))
+    lfn_path = expand_path_grid(lfn)
+    tmpfile = make_tmp_fn(lfn_path)
+    cached = await cache_get(wb, lfn_path)
+    if cached:
+        import shutil
+        try:
+            shutil.copyfile(cached, tmpfile)  # the temporary can be modified (edit) without touching the cache
+            return tmpfile
+        except OSError:  # evicted meanwhile, downloaded again
+            logging.debug(traceback.format_exc())
     copycmd = "-f " + lfn + " " + 'file://' + tmpfile
     result = await ProcessXrootdCp(wb, copycmd.split())
-    if result == 0: return tmpfile
+    if result == 0:
+        cache_put(lfn_path, tmpfile)
+        return tmpfile
+
+
+async def download_cached(wb, lfn):
+    """Local copy of lfn for the viewers: the session temporary, the cache entry or a new download"""
+    lfn_path = expand_path_grid(lfn)
+    tmp = make_tmp_fn(lfn_path)
+    if tmp in AlienSessionInfo['templist']: return tmp
+    cached = await cache_get(wb, lfn_path)
+    if cached: return cached
+    tmp = await download_tmp(wb, lfn)
+    if tmp: AlienSessionInfo['templist'].append(tmp)
+    return tmp
 
 
 async def upload_tmp(wb, temp_file_name, upload_specs = ''):
@@ -746,6 +1776,7 @@ async def upload_tmp(wb, temp_file_name, upload_specs = ''):
     mod_time = f"{datetime.now():%Y%m%d_%H%M%S}"
     lfn_backup = lfn + "_" + mod_time
     result = await SendMsg(wb, 'mv', [lfn, lfn_backup])
+    metacache_invalidate([lfn, lfn_backup])
     json_dict = json.loads(result)
     if json_dict["metadata"]["exitcode"] != '0':
         print("Could not create backup of lfn : {}", lfn)
@@ -754,100 +1785,568 @@ async def upload_tmp(wb, temp_file_name, upload_specs = ''):
     if "disk:" not in upload_specs:
         upload_specs = "disk:" + replicas
 
+    lfn_path = lfn
     if upload_specs: lfn = lfn + "," + upload_specs
     copycmd = "-f " + 'file://' + temp_file_name + " " + lfn
     list_upload = await ProcessXrootdCp(wb, copycmd.split())
+    if list_upload == 0: cache_put(lfn_path, temp_file_name)  # the cache keeps the new content of lfn
     if list_upload: return lfn
 
 
-async def DO_cat(websocket, lfn):
+async def DO_cat(websocket, lfn, shellcmd = None):
     lfn_path = expand_path_grid(lfn)
     tmp = make_tmp_fn(lfn_path)
+    reader = LfnReader()
     if tmp in AlienSessionInfo['templist']:
-        runShellCMD('cat ' + tmp)
+        reader.open_local(tmp)
     else:
-        tmp = await download_tmp(websocket, lfn)
-        if tmp:
-            AlienSessionInfo['templist'].append(tmp)
-            runShellCMD('cat ' + tmp)
+        cached = await cache_get(websocket, lfn_path)
+        if cached:
+            reader.open_local(cached)
+        elif not await reader.open(websocket, lfn_path):
+            return int(2)  # ENOENT /* No such file or directory */
+    try:
+        write_stream(reader.chunks(), shellcmd)  # stream from the storage in bounded buffers, no local copy
+    except IOError as e:
+        print(f"Read error for {lfn} : {e}", flush = True)
+        return int(5)  # EIO /* I/O error */
+    finally:
+        reader.close()
+    return int(0)
 
 
 async def DO_less(websocket, lfn):
-    lfn_path = expand_path_grid(lfn)
-    tmp = make_tmp_fn(lfn_path)
-    if tmp in AlienSessionInfo['templist']:
-        runShellCMD('less ' + tmp)
-    else:
-        tmp = await download_tmp(websocket, lfn)
-        if tmp:
-            AlienSessionInfo['templist'].append(tmp)
-            runShellCMD('less ' + tmp)
+    tmp = await download_cached(websocket, lfn)
+    if tmp: runShellCMD('less ' + tmp)
 
 
 async def DO_more(websocket, lfn):
-    lfn_path = expand_path_grid(lfn)
-    tmp = make_tmp_fn(lfn_path)
-    if tmp in AlienSessionInfo['templist']:
-        runShellCMD('more ' + tmp)
-    else:
-        tmp = await download_tmp(websocket, lfn)
-        if tmp:
+    tmp = await download_cached(websocket, lfn)
+    if tmp: runShellCMD('more ' + tmp)
+
+
+class LfnReader:
+    """Positioned reads of a grid file through the access envelope of one of its replicas
+    Archive members cannot be addressed directly so for them the reads go to a downloaded temporary copy"""
+    def __init__(self):
+        self.file = None
+        self.local = None
+        self.size = int(0)
+
+    async def open(self, wb: websockets.client.WebSocketClientProtocol, lfn: str) -> bool:
+        from XRootD import client
+        envelope_list = await getEnvelope(wb, [lfn])
+        if not envelope_list: return False
+        access_request = json.loads(envelope_list[0]["answer"])
+        if access_request["metadata"]["error"]:
+            print(f"lfn: {lfn} --> {access_request['metadata']['error']}", flush = True)
+            return False
+        if not access_request['results']: return False
+
+        if '#' in access_request['results'][0]['url']:  # archive member
+            tmp = await download_tmp(wb, lfn)
+            if not tmp: return False
             AlienSessionInfo['templist'].append(tmp)
-            runShellCMD('more ' + tmp)
+            return self.open_local(tmp)
+
+        for server in access_request['results']:
+            xrd_file = client.File()
+            status, response = xrd_file.open(server['url'] + '?authz=' + server['envelope'])
+            if status.ok:
+                self.file = xrd_file
+                self.size = int(server['size'])
+                return True
+            if XRDDEBUG: logging.debug(f"Could not open {server['url']} : {status.message}")
+        print(f"lfn: {lfn} --> no replica could be opened for reading", flush = True)
+        return False
 
+    def open_local(self, filename: str) -> bool:
+        self.local = open(filename, 'rb')
+        self.size = int(os.path.getsize(filename))
+        return True
 
-async def DO_quota(wb: websockets, quota_args: list):
-    if len(quota_args) > 0:
-        if quota_args[0] != "set":  # we asume that if 'set' is not used then the argument is a username
-            user = quota_args[0]
-            jquota_cmd = CreateJsonCommand_str('jquota -nomsg list ' + user)
-            fquota_cmd = CreateJsonCommand_str('fquota -nomsg list ' + user)
+    def read(self, offset: int, length: int) -> bytes:
+        if offset >= self.size or length < 1: return b''
+        length = min(length, self.size - offset)
+        if self.local:
+            self.local.seek(offset)
+            return self.local.read(length)
+        data = []
+        nread = int(0)
+        while nread < length:  # keep the size of each remote read bounded
+            status, chunk = self.file.read(offset + nread, min(length - nread, 4194304))
+            if not status.ok: raise IOError(status.message)
+            if not chunk: break
+            data.append(chunk)
+            nread += len(chunk)
+        return b''.join(data)
+
+    def chunks(self, offset: int = 0, length: int = -1, chunksize: int = 4194304):
+        """Iterate over the content in bounded buffers"""
+        end = self.size if length < 0 else min(self.size, offset + length)
+        while offset < end:
+            chunk = self.read(offset, min(chunksize, end - offset))
+            if not chunk: break
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self.file: self.file.close()
+        if self.local: self.local.close()
+
+
+def write_stream(chunks, shellcmd: str = None):
+    """Write the byte chunks to stdout or to the stdin of the shell command as they come"""
+    shell_proc = None
+    sys.stdout.flush()  # text already printed goes before the raw bytes
+    out = sys.stdout.buffer
+    if shellcmd:
+        shell_proc = subprocess.Popen(shellcmd, stdin=subprocess.PIPE, shell=True, env=os.environ)
+        out = shell_proc.stdin
+    try:
+        for chunk in chunks: out.write(chunk)
+        out.flush()
+    except BrokenPipeError:  # the consumer stopped reading (e.g. | head)
+        if not shell_proc: os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())  # no more complaints when stdout is flushed at exit
+    finally:
+        if shell_proc:
+            try:
+                shell_proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            shell_proc.wait()
+
+
+def read_head(reader: LfnReader, lines: int = 10, nbytes: int = 0, chunksize: int = 65536):
+    """The chunks of the first nbytes if specified, otherwise of the first lines of the file, as they are read"""
+    if nbytes > 0:
+        yield from reader.chunks(0, nbytes)
+        return
+    if lines < 1: return
+    newlines = int(0)
+    for chunk in reader.chunks(0, -1, chunksize):
+        count = chunk.count(b'\n')
+        if newlines + count < lines:
+            newlines += count
+            yield chunk
+            continue
+        pos = -1
+        for _ in range(lines - newlines): pos = chunk.find(b'\n', pos + 1)
+        yield chunk[:pos + 1]
+        return
+
+
+def read_tail(reader: LfnReader, lines: int = 10, nbytes: int = 0, chunksize: int = 65536, max_buffered: int = 4194304):
+    """The chunks of the last nbytes if specified, otherwise of the last lines of the file
+    The beginning of the lines is searched backwards keeping up to max_buffered bytes, a longer tail is read again"""
+    if nbytes > 0:
+        yield from reader.chunks(max(reader.size - nbytes, 0), nbytes)
+        return
+    if lines < 1: return
+    buffered = []  # (offset, chunk) read backwards
+    nr_buffered = int(0)
+    newlines = int(0)
+    start = int(0)  # offset of the first of the lines
+    offset = reader.size
+    while offset > 0 and not start:
+        begin = max(offset - chunksize, 0)
+        chunk = reader.read(begin, offset - begin)
+        if not chunk: break
+        pos = len(chunk) - 1 if offset == reader.size and chunk.endswith(b'\n') else len(chunk)  # a final newline does not start a new line
+        while newlines < lines:
+            pos = chunk.rfind(b'\n', 0, pos)
+            if pos < 0: break
+            newlines += 1
+        if newlines == lines: start = begin + pos + 1
+        if buffered is not None:
+            buffered.append((begin, chunk))
+            nr_buffered += len(chunk)
+            if nr_buffered > max_buffered: buffered = None  # too long to be kept, read again
+        offset = begin
+    if buffered is None:
+        yield from reader.chunks(start)
+        return
+    for begin, chunk in reversed(buffered): yield chunk[max(start - begin, 0):]
+
+
+def parse_range(range_arg: str) -> tuple:
+    """offset:length where an empty length means up to the end of file"""
+    offset, _, length = range_arg.partition(':')
+    return int(offset or 0), int(length) if length else -1
+
+
+async def DO_partial_read(wb: websockets.client.WebSocketClientProtocol, cmd: str, args: list, shellcmd: str = None) -> int:
+    """head/tail [-n lines | -c bytes] lfn and cat -r offset:length lfn"""
+    lines = int(10)
+    nbytes = int(0)
+    read_range = None
+    if '-n' in args:
+        n_idx = args.index('-n')
+        lines = int(args.pop(n_idx + 1))
+        args.pop(n_idx)
+    if '-c' in args:
+        c_idx = args.index('-c')
+        nbytes = int(args.pop(c_idx + 1))
+        args.pop(c_idx)
+    if '-r' in args:
+        r_idx = args.index('-r')
+        read_range = parse_range(args.pop(r_idx + 1))
+        args.pop(r_idx)
+    if not args:
+        print(f"{cmd} needs a lfn as argument", flush = True)
+        return int(64)  # EX_USAGE /* command line usage error */
+
+    reader = LfnReader()
+    if not await reader.open(wb, expand_path_grid(args[0])): return int(2)  # ENOENT /* No such file or directory */
+    try:
+        if read_range:
+            offset, length = read_range
+            write_stream(reader.chunks(offset, length), shellcmd)  # streamed, the range can be larger than the memory
+        elif cmd == 'tail':
+            write_stream(read_tail(reader, lines, nbytes), shellcmd)
         else:
-            print('set functionality not implemented yet')
+            write_stream(read_head(reader, lines, nbytes), shellcmd)
+    except IOError as e:
+        print(f"Read error for {args[0]} : {e}", flush = True)
+        return int(5)  # EIO /* I/O error */
+    finally:
+        reader.close()
+    return int(0)
+
+
+async def stat_bulk(wb: websockets.client.WebSocketClientProtocol, lfn_list, window: int = 32):
+    """Stat the lfns with pipelined requests; yield a dict per lfn, in the input order, with either the results or the error"""
+    lfn_queue = deque()
+
+    def stat_cmds():
+        for lfn in lfn_list:
+            lfn_queue.append(lfn)
+            yield 'stat', ['-nomsg', lfn]
+
+    async for answer in SendMsg_pipelined(wb, stat_cmds(), window):
+        lfn = lfn_queue.popleft()
+        json_dict = json.loads(answer)
+        metadata = json_dict["metadata"]
+        if metadata.get("error") or str(metadata.get("exitcode", '0')) != '0':
+            yield {'lfn': lfn, 'error': metadata.get("error", ''), 'exitcode': int(metadata.get("exitcode", 1))}
+        else:
+            yield {'lfn': lfn, 'results': json_dict['results']}
+
+
+async def DO_bulkstat(wb: websockets.client.WebSocketClientProtocol, args: list) -> int:
+    """bulkstat [-T nr_requests_in_flight] <file with lfns | - for stdin> ; prints a json object per line for each lfn"""
+    window = int(32)
+    if '-T' in args:
+        window_idx = args.index('-T')
+        window = int(args.pop(window_idx + 1))
+        args.pop(window_idx)
+    if not args or args[0] == '-h':
+        print("bulkstat [-T nr_requests_in_flight] <file with one lfn per line | - for stdin>", flush = True)
+        return int(64)  # EX_USAGE /* command line usage error */
+
+    try:
+        lfn_file = sys.stdin if args[0] == '-' else open(args[0])
+    except OSError as e:
+        print(f"Could not open {args[0]} : {e}", flush = True)
+        return int(2)  # ENOENT /* No such file or directory */
+
+    lfn_iter = (line.strip() for line in lfn_file if line.strip() and not line.startswith('#'))
+    exitcode = int(0)
+    try:
+        async for entry in stat_bulk(wb, lfn_iter, window):
+            if 'error' in entry: exitcode = int(1)
+            print(json.dumps(entry, separators = (',', ':')))
+    finally:
+        if lfn_file is not sys.stdin: lfn_file.close()
+        sys.stdout.flush()
+    return exitcode
+
+
+def DO_stats(args: list) -> int:
+    """stats [-json] [-reset] [-dump file] ; counts and latencies of the operations of this session"""
+    if '-h' in args:
+        print("""stats [-json] [-reset] [-dump <file>] : count, errors, bytes and latency percentiles of the operations of this session
+    rtt <command> : from sending the command to its answer (server and network time); connect, tls+websocket : connection setup
+    decode : parsing of the answers (also when interleaved with the output), render : writing their output; xrootd transfer : per file copy""", flush = True)
+        return int(0)
+    if '-dump' in args:
+        dump_idx = args.index('-dump')
+        stats.dump(args.pop(dump_idx + 1))
+        args.pop(dump_idx)
+    summary = stats.summary()
+    if '-json' in args or JSON_OUT:
+        print(json.dumps(summary, indent = 4), flush = True)
+    elif NDJSON_OUT:
+        for op in summary: print(json.dumps(op, separators = (',', ':')), flush = True)
     else:
-        user = AlienSessionInfo['user']
-        jquota_cmd = CreateJsonCommand_str('jquota -nomsg list ' + user)
-        fquota_cmd = CreateJsonCommand_str('fquota -nomsg list ' + user)
-
-    await wb.send(jquota_cmd)
-    jquota = await wb.recv()
-    jquota_dict = json.loads(jquota)
-
-    await wb.send(fquota_cmd)
-    fquota = await wb.recv()
-    fquota_dict = json.loads(fquota)
-
-    username = jquota_dict['results'][0]["username"]
-    running_time = float(jquota_dict['results'][0]["totalRunningTimeLast24h"])/3600
-    running_time_max = float(jquota_dict['results'][0]["maxTotalRunningTime"])/3600
-    running_time_perc = (running_time/running_time_max)*100
-    cpucost = float(jquota_dict['results'][0]["totalCpuCostLast24h"])/3600
-    cpucost_max = float(jquota_dict['results'][0]["maxTotalCpuCost"])/3600
-    cpucost_perc = (cpucost/cpucost_max)*100
-    pjobs_nominal = int(jquota_dict['results'][0]["nominalparallelJobs"])
-    pjobs_max = int(jquota_dict['results'][0]["maxparallelJobs"])
-
-    unfinishedjobs_max = int(jquota_dict['results'][0]["maxUnfinishedJobs"])
-    waiting = int(jquota_dict['results'][0]["waiting"])
-
-    size = float(fquota_dict['results'][0]["totalSize"])
-    size_MiB = size/(1024*1024)
-    size_max = float(fquota_dict['results'][0]["maxTotalSize"])
-    size_max_MiB = size_max/(1024*1024)
-    size_perc = (size/size_max)*100
-
-    files = float(fquota_dict['results'][0]["nbFiles"])
-    files_max = float(fquota_dict['results'][0]["maxNbFiles"])
-    files_perc = (files/files_max)*100
-
-    print(f"""Quota report for user : {username}
-Running time (last 24h) :\t{running_time:.2f}/{running_time_max:.2f}(h) --> {running_time_perc:.2f}% used
-CPU Cost :\t\t\t{cpucost:.2f}/{cpucost_max:.2f}(h) --> {cpucost_perc:.2f}% used
-ParallelJobs (nominal/max) :\t{pjobs_nominal}/{pjobs_max}
-Unfinished jobs :\t\tMAX={unfinishedjobs_max}
-Waiting :\t\t\t{waiting}
-Storage size :\t\t\t{size_MiB:.2f}/{size_max_MiB:.2f} MiB --> {size_perc:.2f}%
-Number of files :\t\t{files}/{files_max} --> {files_perc:.2f}%""")
+        print(f"{'operation':<24} {'count':>7} {'errors':>6} {'bytes':>12} {'p50(ms)':>9} {'p90(ms)':>9} {'p99(ms)':>9} {'max(ms)':>9} {'total(s)':>9}")
+        for op in summary:
+            print(f"{op['name']:<24} {op['count']:>7} {op['errors']:>6} {op['bytes']:>12} {op['p50'] * 1000:>9.2f} {op['p90'] * 1000:>9.2f} "
+                  f"{op['p99'] * 1000:>9.2f} {op['max'] * 1000:>9.2f} {op['time']:>9.2f}", flush = True)
+    if '-reset' in args: stats.reset()
+    return int(0)
+
+
+def job_state_final(status: str) -> bool:
+    return status in JOB_STATES_FINAL or status.startswith('ERROR')
+
+
+async def watch_jobs(wb: websockets.client.WebSocketClientProtocol, ps_args: list, interval: float = 10, interval_max: float = 300, max_failures: int = 5) -> int:
+    """Poll ps with ps_args on the connection and print only the state transitions of the listed jobs
+    The poll interval doubles (up to interval_max) while nothing changes; it ends when all jobs are final or no longer listed.
+    A failed poll after the first one keeps the known states and is retried later; it ends with the error after max_failures in a row"""
+    states = {}
+    delay = interval
+    failures = int(0)
+    while True:
+        result = await SendMsg(wb, 'ps', ps_args)
+        json_dict = json.loads(result)
+        if json_dict["metadata"].get("error") and not json_dict['results']:
+            failures += 1
+            if not states or failures >= max_failures:
+                print(f"watch: {json_dict['metadata']['error']}", flush = True)
+                return int(json_dict["metadata"].get("exitcode", 1)) or int(1)
+            logging.info(f"watch: ps failed ({failures}/{max_failures}): {json_dict['metadata']['error']}")
+            delay = min(delay * 2, interval_max)
+            await asyncio.sleep(delay)
+            continue
+        failures = 0
+        now = datetime.now().replace(microsecond=0).isoformat()
+        transitions = []
+        listed = set()
+        for job in json_dict['results']:
+            job_id = str(job.get('id', ''))
+            status = str(job.get('status', ''))
+            listed.add(job_id)
+            if states.get(job_id) != status: transitions.append((job_id, states.get(job_id, ''), status, job.get('name', '')))
+            states[job_id] = status
+        for job_id in [j for j in states if j not in listed]:
+            if not job_state_final(states[job_id]): transitions.append((job_id, states[job_id], '', ''))
+            states.pop(job_id)
+        for job_id, old_status, status, name in transitions:
+            if NDJSON_OUT:
+                print(json.dumps({'time': now, 'id': job_id, 'from': old_status, 'to': status, 'name': name}, separators = (',', ':')))
+            else:
+                print(f"{now} {job_id} {old_status or '(new)'} -> {status or '(not listed)'} {name}")
+        sys.stdout.flush()
+        if not states or all(job_state_final(status) for status in states.values()): return int(0)
+        delay = interval if transitions else min(delay * 2, interval_max)
+        await asyncio.sleep(delay)
+
+
+async def DO_watch(wb: websockets.client.WebSocketClientProtocol, args: list) -> int:
+    """watch [-i seconds] [-max seconds] [ps arguments] ; prints the state transitions of the jobs listed by ps"""
+    interval = float(10)
+    interval_max = float(300)
+    if '-i' in args:
+        interval_idx = args.index('-i')
+        interval = float(args.pop(interval_idx + 1))
+        args.pop(interval_idx)
+    if '-max' in args:
+        max_idx = args.index('-max')
+        interval_max = float(args.pop(max_idx + 1))
+        args.pop(max_idx)
+    if '-h' in args:
+        print("""watch [-i poll_interval] [-max max_poll_interval] [ps arguments, e.g. -id <job id(s)>]
+    poll the jobs listed by ps and print their state transitions until all are final or no longer listed;
+    the interval (default 10s) doubles up to max (default 300s) while nothing changes or a poll fails; 5 failed polls in a row end the watch with an error""", flush = True)
+        return int(0)
+    return await watch_jobs(wb, args, interval, max(interval_max, interval))
+
+
+async def DO_bulksubmit(wb: websockets.client.WebSocketClientProtocol, args: list) -> int:
+    """bulksubmit [-T nr_requests_in_flight] [-watch] <file with one jdl (and its arguments) per line | - for stdin>"""
+    window = int(16)
+    if '-T' in args:
+        window_idx = args.index('-T')
+        window = int(args.pop(window_idx + 1))
+        args.pop(window_idx)
+    watch = '-watch' in args
+    if watch: args.remove('-watch')
+    if not args or args[0] == '-h':
+        print("bulksubmit [-T nr_requests_in_flight] [-watch] <file with one jdl (and its arguments) per line | - for stdin>", flush = True)
+        return int(64)  # EX_USAGE /* command line usage error */
+
+    try:
+        jdl_file = sys.stdin if args[0] == '-' else open(args[0])
+    except OSError as e:
+        print(f"Could not open {args[0]} : {e}", flush = True)
+        return int(2)  # ENOENT /* No such file or directory */
+    with jdl_file:
+        jdl_list = [line.split() for line in jdl_file if line.strip() and not line.startswith('#')]
+
+    exitcode = int(0)
+    job_ids = []
+    jdl_iter = iter(jdl_list)
+    async for answer in SendMsg_pipelined(wb, (('submit', jdl_args) for jdl_args in jdl_list), window):
+        jdl_args = next(jdl_iter)
+        json_dict = json.loads(answer)
+        metadata = json_dict["metadata"]
+        job_id = str(json_dict['results'][0].get('jobId', '')) if json_dict['results'] else ''
+        if not job_id and json_dict['results']:
+            job_id_match = re.search(r"(\d+)", str(json_dict['results'][0].get('message', '')))
+            if job_id_match: job_id = job_id_match.group(1)
+        if not job_id or (str(metadata.get("exitcode", '0')) != '0'):
+            exitcode = int(metadata.get("exitcode", 1)) or int(1)
+            print(f"{' '.join(jdl_args)} : {metadata.get('error', 'no job id')}", flush = True)
+            continue
+        job_ids.append(job_id)
+        print(f"{' '.join(jdl_args)} : {job_id}", flush = True)
+
+    if watch and job_ids:
+        watch_exitcode = await watch_jobs(wb, ['-id', ','.join(job_ids)])
+        if watch_exitcode: exitcode = watch_exitcode
+    return exitcode
+
+
+async def DO_find_paginated(wb: websockets.client.WebSocketClientProtocol, args: list) -> int:
+    """find [options] <directory> <pattern> printed page by page as the pages arrive"""
+    exitcode = None
+    find_opts = args[:-2] if NDJSON_OUT else ['-nokeys'] + args[:-2]
+    async for answer in find_pages(WbPipeline(wb, 2), find_opts, args[-2], args[-1]):
+        if exitcode is None:
+            exitcode = ProcessReceivedMessage(answer)
+        elif find_page_error(JsonAnswer(answer).metadata):  # a failed page ends the listing with its error
+            exitcode = ProcessReceivedMessage(answer)
+        elif next(JsonAnswer(answer).results(), None) is not None:  # an empty last page is not an error
+            ProcessReceivedMessage(answer)
+    return int(exitcode)
+
+
+def quota_info(user: str, jquota_answer: str, fquota_answer: str) -> dict:
+    """Job and file quota of user from the answers of jquota and fquota; times in hours and sizes in MiB"""
+    def perc(value: float, value_max: float) -> float: return (value / value_max) * 100 if value_max else float(0)
+    jquota_dict = json.loads(jquota_answer)
+    fquota_dict = json.loads(fquota_answer)
+    for answer_dict in (jquota_dict, fquota_dict):
+        if not answer_dict['results'] or answer_dict["metadata"].get("error"):
+            return {'user': user, 'error': answer_dict["metadata"].get("error", 'no quota information'), 'max_perc': float(0)}
+    jquota = jquota_dict['results'][0]
+    fquota = fquota_dict['results'][0]
+
+    info = {'user': jquota.get("username", user)}
+    info['running_time'] = float(jquota["totalRunningTimeLast24h"])/3600
+    info['running_time_max'] = float(jquota["maxTotalRunningTime"])/3600
+    info['running_time_perc'] = perc(info['running_time'], info['running_time_max'])
+    info['cpucost'] = float(jquota["totalCpuCostLast24h"])/3600
+    info['cpucost_max'] = float(jquota["maxTotalCpuCost"])/3600
+    info['cpucost_perc'] = perc(info['cpucost'], info['cpucost_max'])
+    info['pjobs_nominal'] = int(jquota["nominalparallelJobs"])
+    info['pjobs_max'] = int(jquota["maxparallelJobs"])
+    info['unfinishedjobs_max'] = int(jquota["maxUnfinishedJobs"])
+    info['waiting'] = int(jquota["waiting"])
+    info['size'] = float(fquota["totalSize"])/(1024*1024)
+    info['size_max'] = float(fquota["maxTotalSize"])/(1024*1024)
+    info['size_perc'] = perc(info['size'], info['size_max'])
+    info['files'] = float(fquota["nbFiles"])
+    info['files_max'] = float(fquota["maxNbFiles"])
+    info['files_perc'] = perc(info['files'], info['files_max'])
+    info['max_perc'] = max(info['running_time_perc'], info['cpucost_perc'], info['size_perc'], info['files_perc'])
+    return info
+
+
+async def quota_bulk(wb: websockets.client.WebSocketClientProtocol, users: list, window: int = 32) -> list:
+    """quota_info of all users, with the jquota and fquota requests pipelined"""
+    cmd_list = []
+    for user in users: cmd_list.extend((('jquota', ['-nomsg', 'list', user]), ('fquota', ['-nomsg', 'list', user])))
+    answers = [answer async for answer in SendMsg_pipelined(wb, cmd_list, window)]
+    return [quota_info(user, answers[2 * i], answers[2 * i + 1]) for i, user in enumerate(users)]
+
+
+def quota_usage():
+    print("""quota [user] : quota report for user (defaults to the current user)
+quota [-u user1,user2,...] [-f <file with one user per line | - for stdin>] [-sort field] [-min percent] [-json | -ndjson] [-T nr_requests_in_flight]
+    table (or json) of the quotas of all the users, fetched concurrently
+    -sort : sort (descending) by one of user, running_time_perc, cpucost_perc, size_perc, files_perc, waiting, max_perc (default)
+    -min : show only the users with at least this percent used of any limit (and the users whose quota could not be fetched)""", flush = True)
+
+
+async def DO_quota(wb: websockets, quota_args: list) -> int:
+    if quota_args and quota_args[0] == "set":
+        print('set functionality not implemented yet', flush = True)
+        return int(38)  # ENOSYS /* Function not implemented */
+    if '-h' in quota_args:
+        quota_usage()
+        return int(0)
+
+    users = []
+    if '-u' in quota_args:
+        users_idx = quota_args.index('-u')
+        users.extend(u for u in quota_args.pop(users_idx + 1).split(',') if u)
+        quota_args.pop(users_idx)
+    if '-f' in quota_args:
+        file_idx = quota_args.index('-f')
+        users_fn = quota_args.pop(file_idx + 1)
+        quota_args.pop(file_idx)
+        try:
+            users_file = sys.stdin if users_fn == '-' else open(users_fn)
+        except OSError as e:
+            print(f"Could not open {users_fn} : {e}", flush = True)
+            return int(2)  # ENOENT /* No such file or directory */
+        users.extend(line.strip() for line in users_file if line.strip() and not line.startswith('#'))
+        if users_file is not sys.stdin: users_file.close()
+    sort_field = 'max_perc'
+    if '-sort' in quota_args:
+        sort_idx = quota_args.index('-sort')
+        sort_field = quota_args.pop(sort_idx + 1)
+        quota_args.pop(sort_idx)
+    min_perc = None
+    if '-min' in quota_args:
+        min_idx = quota_args.index('-min')
+        min_perc = float(quota_args.pop(min_idx + 1))
+        quota_args.pop(min_idx)
+    window = int(32)
+    if '-T' in quota_args:
+        window_idx = quota_args.index('-T')
+        window = int(quota_args.pop(window_idx + 1))
+        quota_args.pop(window_idx)
+    out_json = JSON_OUT or ('-json' in quota_args)
+    out_ndjson = NDJSON_OUT or ('-ndjson' in quota_args)
+    quota_args = [arg for arg in quota_args if arg not in ('-json', '-ndjson')]
+    users.extend(quota_args)
+
+    if len(users) < 2 and not (sort_field != 'max_perc' or min_perc is not None or out_json or out_ndjson):  # the report of one user
+        info = (await quota_bulk(wb, users or [AlienSessionInfo['user']]))[0]
+        if 'error' in info:
+            print(f"Quota report for user {info['user']} : {info['error']}", flush = True)
+            return int(1)
+        print(f"""Quota report for user : {info['user']}
+Running time (last 24h) :\t{info['running_time']:.2f}/{info['running_time_max']:.2f}(h) --> {info['running_time_perc']:.2f}% used
+CPU Cost :\t\t\t{info['cpucost']:.2f}/{info['cpucost_max']:.2f}(h) --> {info['cpucost_perc']:.2f}% used
+ParallelJobs (nominal/max) :\t{info['pjobs_nominal']}/{info['pjobs_max']}
+Unfinished jobs :\t\tMAX={info['unfinishedjobs_max']}
+Waiting :\t\t\t{info['waiting']}
+Storage size :\t\t\t{info['size']:.2f}/{info['size_max']:.2f} MiB --> {info['size_perc']:.2f}%
+Number of files :\t\t{info['files']}/{info['files_max']} --> {info['files_perc']:.2f}%""", flush = True)
+        return int(0)
+
+    if not users: users = [AlienSessionInfo['user']]
+    quotas = await quota_bulk(wb, users, window)
+    if min_perc is not None: quotas = [info for info in quotas if 'error' in info or info['max_perc'] >= min_perc]  # the failed lookups are always shown
+    try:
+        quotas.sort(key = lambda info: info.get(sort_field, 0), reverse = (sort_field != 'user'))
+    except TypeError:
+        print(f"quota: cannot sort by {sort_field}", flush = True)
+        return int(22)  # EINVAL /* Invalid argument */
+
+    exitcode = int(1) if any('error' in info for info in quotas) else int(0)
+    if out_ndjson:
+        for info in quotas: print(json.dumps(info, separators = (',', ':')))
+    elif out_json:
+        print(json.dumps(quotas, indent = 4))
+    else:
+        print(f"{'user':<16} {'run time(h)':>23} {'cpu cost(h)':>23} {'jobs':>11} {'waiting':>8} {'size(MiB)':>27} {'files':>23}")
+        for info in quotas:
+            if 'error' in info:
+                print(f"{info['user']:<16} {info['error']}")
+                continue
+            print(f"{info['user']:<16} {info['running_time']:>9.1f}/{info['running_time_max']:<9.1f}{info['running_time_perc']:>3.0f}% "
+                  f"{info['cpucost']:>9.1f}/{info['cpucost_max']:<9.1f}{info['cpucost_perc']:>3.0f}% "
+                  f"{info['pjobs_nominal']:>5}/{info['pjobs_max']:<5} {info['waiting']:>8} "
+                  f"{info['size']:>11.1f}/{info['size_max']:<11.1f}{info['size_perc']:>3.0f}% "
+                  f"{info['files']:>9.0f}/{info['files_max']:<9.0f}{info['files_perc']:>3.0f}%")
+    sys.stdout.flush()
+    return exitcode
 
 
 async def DO_edit(websocket, lfn, editor='mcedit'):
@@ -894,6 +2393,87 @@ def check_port(address, port):
         return False
 
 
+JSON_DECODER = json.JSONDecoder()
+RE_JSON_WS = re.compile(r"[ \t\n\r]*")
+
+
+class JsonAnswer:
+    """A server answer decoded incrementally: the metadata right away and the entries of results one at a time,
+    when iterated, so that a large answer never exists as a full tree next to its text"""
+    def __init__(self, message: str):
+        self.message = message
+        self.metadata = {}
+        self.results_pos = None  # position of the [ of results
+        self.decode_time = float(0)  # seconds spent decoding, the scan and the entries iterated so far
+        begin = time.time()
+        try:
+            self.scan()
+        except IndexError:
+            raise ValueError("truncated json answer") from None
+        finally:
+            self.decode_time = time.time() - begin  # the entries skipped by scan are included once
+
+    def scan(self):
+        message = self.message
+        pos = self.skip(0)
+        if message[pos] != '{': raise ValueError("json object expected")
+        pos = self.skip(pos + 1)
+        while message[pos] != '}':
+            key, pos = JSON_DECODER.raw_decode(message, pos)
+            pos = self.skip(pos)
+            if message[pos] != ':': raise ValueError(f"':' expected at {pos}")
+            pos = self.skip(pos + 1)
+            if key == 'results' and message[pos] == '[':
+                self.results_pos = pos
+                if self.metadata: break  # nothing else is needed
+                pos = self.skip(pos + 1) + 1
+                if message[pos - 1] != ']':
+                    for entry, pos in self.entries(): pass  # skipped, one entry at a time, to reach the following keys
+            else:
+                value, pos = JSON_DECODER.raw_decode(message, pos)
+                if key == 'metadata': self.metadata = value
+                if self.metadata and self.results_pos is not None: break
+            pos = self.skip(pos)
+            if message[pos] == ',': pos = self.skip(pos + 1)
+
+    def skip(self, pos: int) -> int:
+        return RE_JSON_WS.match(self.message, pos).end()
+
+    def entries(self):
+        """(entry, end position) for each entry of results"""
+        try:
+            yield from self.scan_entries()
+        except IndexError:
+            raise ValueError("truncated json answer") from None
+
+    def scan_entries(self):
+        if self.results_pos is None: return
+        message = self.message
+        pos = self.skip(self.results_pos + 1)
+        if message[pos] == ']': return
+        scan_once = JSON_DECODER.scan_once
+        while True:
+            begin = time.time()
+            try:
+                entry, pos = scan_once(message, pos)
+            except StopIteration as e:
+                raise ValueError(f"json value expected at {e.value}") from None
+            finally:
+                self.decode_time += time.time() - begin
+            if message[pos] in ' \t\n\r': pos = self.skip(pos)  # the answers are usually compact
+            yield entry, pos + 1
+            if message[pos] == ']': return
+            if message[pos] != ',': raise ValueError(f"',' or ']' expected at {pos}")
+            pos += 1
+            if message[pos] in ' \t\n\r': pos = self.skip(pos)
+
+    def results(self):
+        for entry, pos in self.entries(): yield entry
+
+    def count(self) -> int:
+        return sum(1 for entry in self.entries())
+
+
 def CreateJsonCommand(cmd: str, options: list = []) -> str:
     jsoncmd = {"command": cmd, "options": options}
     if DEBUG: logging.debug(f'send json: {jsoncmd}')
@@ -912,9 +2492,24 @@ def PrintDict(dict):
 
 async def SendMsg(wb: websockets.client.WebSocketClientProtocol, cmd: str, args: list = []) -> str:
     if not wb or not cmd: return ''
-    await wb.send(CreateJsonCommand(cmd, args))
-    result = await wb.recv()
-    return result
+    replayed = False  # a request is sent again at most once
+    while True:
+        generation = getattr(wb, 'generation', 0)
+        sent = False
+        begin = time.time()
+        try:
+            await wb.send(CreateJsonCommand(cmd, args))
+            sent = True
+            result = await wb.recv()
+            stats.record('rtt ' + cmd, time.time() - begin, len(result))
+            return result
+        except (websockets.exceptions.ConnectionClosed, OSError) as e:
+            stats.record('rtt ' + cmd, time.time() - begin, error = True)
+            if not isinstance(wb, AlienWebSocket): raise
+            logging.error(traceback.format_exc())
+            if not await wb.reconnect(generation): return answer_not_connected(cmd)
+            if replayed or (sent and (ws_close_permanent(e) or not cmd_replayable(cmd, args))): return answer_not_connected(cmd, e)
+            replayed = True
 
 
 async def SendMsg_str(wb: websockets.client.WebSocketClientProtocol, cmd_line: str) -> str:
@@ -931,39 +2526,232 @@ async def SendMsg_json(wb: websockets.client.WebSocketClientProtocol, json: str)
     return result
 
 
+async def SendMsg_pipelined(wb: websockets.client.WebSocketClientProtocol, cmd_list, window: int = 32):
+    """Send the (cmd, args) items of cmd_list keeping up to window requests in flight and yield the answers in the same order
+    wb can also be a WbPipeline shared with other requests; answers from the metadata cache are not sent"""
+    pipeline = wb if isinstance(wb, WbPipeline) else WbPipeline(wb, window)
+
+    async def answer(cmd: str, args: list) -> str:
+        cached = metacache.get(cmd, args) if (metacache and cmd in CMDS_METACACHE) else ''
+        if cached: return cached
+        result = await pipeline.request(cmd, args)
+        if metacache and cmd in CMDS_METACACHE: metacache.put(cmd, args, result)
+        return result
+
+    pending = deque()
+    for cmd, args in cmd_list:
+        pending.append(asyncio.ensure_future(answer(cmd, args)))
+        while len(pending) >= max(int(window), 1): yield await pending.popleft()
+    while pending: yield await pending.popleft()
+
+
 async def AlienSession(cmd):
     if not cmd: return ''
     wb = await AlienConnect()
     if not wb: return ''
-    result = await SendMsg_json(wb, json)
+    try:
+        result = await SendMsg_json(wb, cmd)
+    finally:
+        await wb.close()
     return json.loads(result)
 
 
+class AlienClient:
+    """Client keeping its connection for any number of commands, to be used as
+        async with AlienClient() as client:
+            files = await client.find('/alice/data/2018/LHC18b/', '*.root')
+    The commands of concurrent coroutines are pipelined on the connection (at most window in flight) and the answers
+    of stat/whereis/lfn2guid/guid2lfn are taken from the metadata cache when enabled; cp runs on a second connection.
+    Failed commands raise OSError with the exitcode and the error message of the server"""
+    def __init__(self, window: int = 32):
+        self.window = window
+        self.wb = None
+        self.pipeline = None
+        self.cp_wbs = []  # connections for cp, one per copy in progress
+        self.cp_idle = []
+        self.connect_lock = None
+        self.renew_task = None
+        self.user = ''
+        self.home = ''
+        self.currentdir = ''
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _connect(self):
+        try:
+            return AlienWebSocket(await AlienConnect(), lambda: self.currentdir)
+        except SystemExit:  # AlienConnect exits when no connection is possible
+            raise ConnectionError(f"Could not connect to {os.getenv('ALIENPY_JCENTRAL', 'alice-jcentral.cern.ch')}") from None
+
+    async def connect(self):
+        if self.connect_lock is None: self.connect_lock = asyncio.Lock()  # created in the loop of the client
+        async with self.connect_lock:
+            if self.wb: return
+            self.wb = await self._connect()
+            self.pipeline = WbPipeline(self.wb, self.window)
+            result = await self.run('whoami')
+            self.user = str(result.results[0]['message']).strip() if result.results else ''
+            if not self.home: self.home = result.currentdir
+            if TOKEN_RENEW > 0 and not self.renew_task: self.renew_task = asyncio.ensure_future(self.token_renewal())
+
+    async def token_renewal(self):
+        """Renew the token on this connection ahead of its expiry, for the next connections"""
+        while self.wb:
+            remaining = CertTimeRemaining(token_files()[0])
+            await asyncio.sleep(max(remaining - TOKEN_RENEW, 60))
+            try:
+                if self.pipeline: await token(self.pipeline, TOKEN_RENEW)
+            except Exception:
+                logging.error(traceback.format_exc())
+
+    async def close(self):
+        if self.renew_task: self.renew_task.cancel()
+        self.renew_task = None
+        for wb in [self.wb] + self.cp_wbs:
+            if wb: await wb.close()
+        self.wb = self.pipeline = None
+        self.cp_wbs = []
+        self.cp_idle = []
+
+    async def request(self, cmd: str, args: list = []) -> str:
+        """The raw answer of a server command"""
+        if not self.wb: await self.connect()
+        answer = metacache.get(cmd, args) if (metacache and cmd in CMDS_METACACHE) else ''
+        if not answer:
+            answer = await self.pipeline.request(cmd, args)
+            if metacache and cmd in CMDS_METACACHE: metacache.put(cmd, args, answer)
+        if metacache and cmd in CMDS_CATALOGUE_MUTATING: metacache_invalidate(args)
+        return answer
+
+    async def run(self, cmd: str, *args: str) -> AlienResult:
+        """Any server command; the answer is not checked for errors"""
+        result = AlienResult.from_answer(await self.request(cmd, list(args)))
+        if result.currentdir: self.currentdir = result.currentdir
+        return result
+
+    async def check(self, cmd: str, *args: str) -> AlienResult:
+        result = await self.run(cmd, *args)
+        if result.exitcode != 0 or (result.error and not result.results):
+            raise OSError(result.exitcode or 1, result.error, args[-1] if args else cmd)
+        return result
+
+    async def ls(self, path: str = '', *options: str) -> list:
+        """Names of the entries of path; directories end with /"""
+        result = await self.check('ls', '-nokeys', '-F', *options, *([path] if path else []))
+        return [str(item['message']) for item in result.results]
+
+    async def find(self, directory: str, pattern: str = '*', *options: str) -> list:
+        """StatInfo of the entries found, requested in pages"""
+        if not self.wb: await self.connect()
+        entries = []
+        async for entry in find_paginated(self.pipeline, ['-nomsg'] + list(options), directory, pattern):
+            entries.append(StatInfo.from_dict(entry))
+        return entries
+
+    async def stat(self, lfn: str) -> StatInfo:
+        result = await self.check('stat', '-nomsg', lfn)
+        return StatInfo.from_dict(result.results[0])
+
+    async def access(self, lfn: str, mode: str = 'read', *specs: str) -> list:
+        """The replicas (for read) or the destinations (for write) of lfn with their envelopes"""
+        result = await self.check('access', '-nomsg', mode, lfn, *([','.join(specs)] if specs else []))
+        return [Replica.from_dict(entry) for entry in result.results]
+
+    @staticmethod
+    def cp_path(path: str) -> str:
+        """alien:/path is the grid path /path and file:/path or file:///path the local /path, as cp expects them"""
+        if path.startswith('alien:'): return path[len('alien:'):]
+        if path.startswith('file:') and not path.startswith('file://'): return 'file://' + path[len('file:'):]
+        return path
+
+    async def cp(self, src: str, dst: str, *options: str) -> int:
+        """Copy with the options of the cp command; grid paths are absolute, optionally alien: prefixed, local paths are file: prefixed.
+        Returns the exitcode; each copy in progress has a connection of its own, kept for the next copies"""
+        wb = self.cp_idle.pop() if self.cp_idle else None
+        if not wb:
+            wb = await self._connect()
+            self.cp_wbs.append(wb)
+        try:
+            return int(await ProcessXrootdCp(wb, list(options) + [self.cp_path(src), self.cp_path(dst)]))
+        finally:
+            if wb in self.cp_wbs: self.cp_idle.append(wb)
+
+
+class AlienClientSync:
+    """Synchronous AlienClient for threaded code: the methods can be called from any number of threads at once,
+    the calls run on a private event loop in a background thread and are multiplexed (pipelined) on the given number of connections;
+    the transfer of a cp runs in a thread of its own, so it does not hold the calls of the other threads
+        with AlienClientSync() as client: info = client.stat('/alice/cern.ch/user/a/auser/file')"""
+    def __init__(self, connections: int = 1, window: int = 32, timeout: float = None):
+        self.timeout = timeout
+        self.bg = BackgroundLoop()
+        self.clients = [AlienClient(window) for i in range(max(int(connections), 1))]
+        self.calls = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def call(self, method: str, *args):
+        client = self.clients[next(self.calls) % len(self.clients)]
+        return self.bg.submit(getattr(client, method)(*args)).result(self.timeout)
+
+    def close(self):
+        for client in self.clients: self.bg.submit(client.close()).result(self.timeout)
+        self.bg.stop()
+
+    def request(self, cmd: str, args: list = []) -> str: return self.call('request', cmd, args)
+    def run(self, cmd: str, *args: str) -> AlienResult: return self.call('run', cmd, *args)
+    def ls(self, path: str = '', *options: str) -> list: return self.call('ls', path, *options)
+    def find(self, directory: str, pattern: str = '*', *options: str) -> list: return self.call('find', directory, pattern, *options)
+    def stat(self, lfn: str) -> StatInfo: return self.call('stat', lfn)
+    def access(self, lfn: str, mode: str = 'read', *specs: str) -> list: return self.call('access', lfn, mode, *specs)
+    def cp(self, src: str, dst: str, *options: str) -> int: return self.call('cp', src, dst, *options)
+
+
+alien_client_sync = None
+alien_client_sync_lock = threading.Lock()
+
+
 def AlienSendCmd(cmd):
-    return asyncio.get_event_loop().run_until_complete(AlienSession(cmd))
+    """Send a json command (see CreateJsonCommand) and return the answer as dict; can be called from any thread,
+    all the calls share the connection of a background client"""
+    global alien_client_sync
+    with alien_client_sync_lock:
+        if not alien_client_sync: alien_client_sync = AlienClientSync()
+    jsoncmd = json.loads(cmd)
+    return json.loads(alien_client_sync.request(jsoncmd['command'], jsoncmd.get('options', [])))
 
 
-def IsValidCert(fname):
+def CertTimeRemaining(fname) -> int:
+    """Seconds until the certificate expires; -1 if it cannot be read"""
     try:
         with open(fname) as f:
             cert_bytes = f.read()
     except Exception:
-        return False
+        return int(-1)
 
     try:
         x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, cert_bytes)
     except Exception:
-        return False
+        return int(-1)
 
     x509_notafter = x509.get_notAfter()
     utc_time = datetime.strptime(x509_notafter.decode("utf-8"), "%Y%m%d%H%M%SZ")
     time_notafter = int((utc_time - datetime(1970, 1, 1)).total_seconds())
     time_current  = int(datetime.now().timestamp())
-    time_remaining = time_notafter - time_current
-    if (time_remaining > 300):
-        return True
-    else:
-        return False
+    return time_notafter - time_current
+
+
+def IsValidCert(fname):
+    return CertTimeRemaining(fname) > 300
 
 
 def CertInfo(fname):
@@ -988,6 +2776,15 @@ def CertInfo(fname):
     return int(0)
 
 
+def cert_subject(fname: str) -> str:
+    try:
+        with open(fname) as f:
+            x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, f.read())
+    except Exception:
+        return ''
+    return '/%s' % ('/'.join(['%s=%s' % (k.decode("utf-8"), v.decode("utf-8")) for k, v in x509.get_subject().get_components()]))
+
+
 def create_ssl_context():
     # SSL SETTINGS
     usercert = os.getenv('X509_USER_CERT', Path.home().as_posix() + '/.globus' + '/usercert.pem')
@@ -1022,10 +2819,6 @@ def create_ssl_context():
     cert = usercert
     key  = userkey
 
-    if IsValidCert(tokencert):
-        cert = tokencert
-        key  = tokenkey
-
     ctx = ssl.SSLContext(ssl.PROTOCOL_TLS)
     ctx.options |= ssl.OP_NO_SSLv3
     ctx.verify_mode = ssl.CERT_REQUIRED  # CERT_NONE, CERT_OPTIONAL, CERT_REQUIRED
@@ -1034,7 +2827,12 @@ def create_ssl_context():
         ctx.load_verify_locations(cafile = x509file)
     else:
         ctx.load_verify_locations(capath = capath_default)
-    ctx.load_cert_chain(certfile=cert, keyfile=key)
+    with token_lock(fcntl.LOCK_SH):  # the token files are not read while being renewed
+        if IsValidCert(tokencert):
+            cert = tokencert
+            key  = tokenkey
+        ctx.load_cert_chain(certfile=cert, keyfile=key)
+    AlienSessionInfo['cert_subject'] = cert_subject(cert)
     if DEBUG: logging.debug(f"Cert = {cert} ; Key = {key}")
     return ctx
 
@@ -1056,22 +2854,98 @@ async def wb_create(host: str, port: Union[str, int], path: str) -> Union[websoc
     socket = None
     # https://async-stagger.readthedocs.io/en/latest/reference.html#async_stagger.create_connected_sock
     # AI_* flags --> https://linux.die.net/man/3/getaddrinfo
+    begin = time.time()
     try:
         socket = await async_stagger.create_connected_sock(host, int(port), async_dns=True, resolution_delay=0.050, detailed_exceptions=True)
     except Exception as e:
         logging.debug(traceback.format_exc())
+    stats.record('connect', time.time() - begin, error = not socket)
 
     websocket = None
     if socket:
+        begin = time.time()
         try:
             websocket = await websockets.connect(fHostWSUrl, sock=socket, server_hostname=host,
                                                  ssl=ctx, max_queue=QUEUE_SIZE, max_size=MSG_SIZE, ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT, close_timeout=CLOSE_TIMEOUT)
         except Exception as e:
             logging.debug(traceback.format_exc())
+        stats.record('tls+websocket', time.time() - begin, error = not websocket)
     if websocket and DEBUG: logging.debug(f"ENDPOINT : {socket.getpeername()[0]}:{socket.getpeername()[1]}")
     return websocket
 
 
+class AlienWebSocket:
+    """A connection that can be replaced by a new one when it is lost, with the current directory restored
+    The requests in flight when the connection drops are retried once by SendMsg and WbPipeline if they were not sent
+    or if the command is idempotent and the close would not repeat (see WS_CLOSE_PERMANENT); the other ones fail with ENOTCONN"""
+    def __init__(self, ws, currentdir = None):
+        self.ws = ws
+        self.currentdir = currentdir or (lambda: AlienSessionInfo['currentdir'])  # the directory to restore
+        self.generation = int(0)  # incremented at each reconnection
+        self.reconnect_lock = None
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
+
+    async def send(self, message):
+        await self.ws.send(message)
+
+    async def recv(self):
+        return await self.ws.recv()
+
+    async def reconnect(self, generation: int) -> bool:
+        """Replace the connection of the given generation, if not already done by a concurrent request; False if not possible"""
+        if self.reconnect_lock is None: self.reconnect_lock = asyncio.Lock()
+        async with self.reconnect_lock:
+            if self.generation != generation: return True
+            try:
+                await self.ws.close()
+            except Exception:
+                logging.debug(traceback.format_exc())
+            for nr_try in range(RECONNECT_TRIES):
+                await asyncio.sleep(min(2 ** nr_try, 30))  # backoff, e.g. for a restart of the server
+                try:
+                    ws = await AlienConnect()
+                except (Exception, SystemExit):  # AlienConnect exits when no connection is possible
+                    logging.error(traceback.format_exc())
+                    continue
+                currentdir = self.currentdir()
+                if currentdir:
+                    await ws.send(CreateJsonCommand('cd', [currentdir]))
+                    await ws.recv()
+                self.ws = ws
+                self.generation += 1
+                logging.info(f"Reconnected to {AlienSessionInfo['server']} after {nr_try + 1} tries")
+                return True
+            return False
+
+
+def answer_not_connected(cmd: str, e: Exception = None) -> str:
+    """The answer of a command lost with the connection that is not sent (again): no connection, it might have been executed,
+    it was already sent again or it would fail again"""
+    if e is None:
+        error = f"Connection lost and not restored, {cmd} might or might not have been executed"
+    elif ws_close_permanent(e):
+        error = f"Connection closed during {cmd} ({e}), not retried as it would fail again"
+    else:
+        error = f"Connection lost, {cmd} might or might not have been executed"
+    return json.dumps({"metadata": {"exitcode": "107", "currentdir": AlienSessionInfo['currentdir'],  # ENOTCONN /* Transport endpoint is not connected */
+                                    "error": error}, "results": []})
+
+
+def ws_close_permanent(e: Exception) -> bool:
+    """True if the connection was closed with a code after which the same request would fail again, e.g. 1009 for a too big answer"""
+    frames = [frame for frame in (getattr(e, 'rcvd', None), getattr(e, 'sent', None)) if frame is not None]  # websockets >= 10
+    codes = [frame.code for frame in frames] if frames else [getattr(e, 'code', 0)]
+    return any(code in WS_CLOSE_PERMANENT for code in codes)
+
+
+def cmd_replayable(cmd: str, args: list = []) -> bool:
+    """True if the command can be sent again when its answer was lost with the connection"""
+    if cmd not in CMDS_IDEMPOTENT: return False
+    return not (cmd == 'find' and '-x' in args)  # find -x creates a collection
+
+
 async def AlienConnect():
     jalien_websocket_port = 8097  # websocket port
     jalien_websocket_path = '/websocket/json'
@@ -1123,32 +2997,122 @@ async def AlienConnect():
                     break
 
     if not websocket: sys.exit(1)
+    AlienSessionInfo['server'] = f"{jalien_server}:{jalien_websocket_port}"
     await token(websocket)  # it will return if token is valid, if not it will request and write it to file
     # print(json.dumps(ssl_context.get_ca_certs(), sort_keys=True, indent=4), flush = True)
     return websocket
 
 
-async def token(wb):
-    if not wb: return
+def token_files() -> tuple:
     tokencert = os.getenv('JALIEN_TOKEN_CERT', os.getenv('TMPDIR', '/tmp') + '/tokencert_' + str(os.getuid()) + '.pem')
     tokenkey = os.getenv('JALIEN_TOKEN_KEY', os.getenv('TMPDIR', '/tmp') + '/tokenkey_' + str(os.getuid()) + '.pem')
+    return tokencert, tokenkey
 
-    # if the certificate used is not the token, then get one
-    if IsValidCert(tokencert): return
 
-    result = await SendMsg(wb, 'token', ['-nomsg'])
-    json_dict = json.loads(result)
+class token_lock:
+    """flock on the lock file of the token; shared while reading (with), exclusive while renewing (async with),
+    with the renewals of all the threads and loops of this process done one at a time.
+    After timeout seconds it goes on without the lock; a reader in the thread renewing does not wait for its own renewal"""
+    renewing = threading.Lock()  # the renewal in progress in this process
+    renewer = None  # thread of the renewal in progress
 
-    tokencert_content = json_dict['results'][0]["tokencert"]
-    tokenkey_content  = json_dict['results'][0]["tokenkey"]
+    def __init__(self, operation: int = fcntl.LOCK_EX, timeout: float = 10):
+        self.operation = operation
+        self.timeout = timeout
+        self.lock_file = None
+        self.deadline = float(0)
 
-    if os.path.isfile(tokencert): os.chmod(tokencert, 0o700)  # make it writeable
-    with open(tokencert, "w") as tcert: print(f"{tokencert_content}", file=tcert)  # write the tokencert
-    os.chmod(tokencert, 0o400)  # make it readonly
+    def open(self) -> bool:
+        try:
+            self.lock_file = open(token_files()[0] + '.lock', 'a')
+        except OSError:  # no locking possible (e.g. not writable TMPDIR), go on without
+            self.give_up()
+            return False
+        self.deadline = time.time() + self.timeout
+        return True
 
-    if os.path.isfile(tokenkey): os.chmod(tokenkey, 0o700)  # make it writeable
-    with open(tokenkey, "w") as tkey: print(f"{tokenkey_content}", file=tkey)  # write the tokenkey
-    os.chmod(tokenkey, 0o400)  # make it readonly
+    def try_lock(self) -> bool:
+        """True when the lock is taken or given up, False when it is to be tried again"""
+        try:
+            fcntl.flock(self.lock_file, self.operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if time.time() <= self.deadline: return False
+            self.give_up()
+        except OSError:
+            self.give_up()
+        return True
+
+    def give_up(self):
+        logging.debug(traceback.format_exc())
+        if self.lock_file: self.lock_file.close()
+        self.lock_file = None
+
+    def __enter__(self):
+        if token_lock.renewer == threading.get_ident(): return self
+        if self.open():
+            while not self.try_lock(): time.sleep(0.05)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.lock_file: self.lock_file.close()
+        self.lock_file = None
+
+    async def __aenter__(self):
+        while not token_lock.renewing.acquire(blocking = False): await asyncio.sleep(0.05)  # the event loop is not blocked while waiting
+        token_lock.renewer = threading.get_ident()
+        try:
+            if self.open():
+                while not self.try_lock(): await asyncio.sleep(0.05)
+        except BaseException:  # e.g. cancelled while waiting for another process
+            await self.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__exit__(exc_type, exc, tb)
+        token_lock.renewer = None
+        token_lock.renewing.release()
+
+
+def token_write(fname: str, content: str):
+    """Replace the token file atomically with a new readonly file"""
+    fname_tmp = f'{fname}.{os.getpid()}'
+    with open(os.open(fname_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f: print(f"{content}", file=f)
+    os.chmod(fname_tmp, 0o400)  # make it readonly
+    os.replace(fname_tmp, fname)
+
+
+async def token(wb, renew_before: float = 300):
+    """Get a new token if the current one has less than renew_before seconds left;
+    concurrent renewals (processes, threads, coroutines) wait for the one renewing it and then use its token"""
+    if not wb: return
+    tokencert, tokenkey = token_files()
+
+    # if the certificate used is not the token, then get one
+    if CertTimeRemaining(tokencert) > renew_before: return
+    async with token_lock(fcntl.LOCK_EX):
+        if CertTimeRemaining(tokencert) > renew_before: return  # renewed by another process or thread meanwhile
+        result = await (wb.request('token', ['-nomsg']) if isinstance(wb, WbPipeline) else SendMsg(wb, 'token', ['-nomsg']))
+        json_dict = json.loads(result)
+        if not json_dict['results'] or "tokencert" not in json_dict['results'][0]:
+            logging.error(f"Token renewal failed: {json_dict['metadata'].get('error', '')}")
+            return
+
+        tokencert_content = json_dict['results'][0]["tokencert"]
+        tokenkey_content  = json_dict['results'][0]["tokenkey"]
+        token_write(tokenkey, tokenkey_content)  # the key first: a reader without lock can only see a new key with the old cert for a short time
+        token_write(tokencert, tokencert_content)
+    AlienSessionInfo['token_check'] = time.time()
+
+
+async def token_renew_check(wb):
+    """Renew the token ahead of its expiry; the certificate is looked at most once per minute"""
+    if TOKEN_RENEW <= 0 or (time.time() - AlienSessionInfo['token_check']) < 60: return
+    AlienSessionInfo['token_check'] = time.time()
+    try:
+        await token(wb, TOKEN_RENEW)
+    except Exception:
+        logging.error(traceback.format_exc())
 
 
 async def InitConnection():
@@ -1156,10 +3120,11 @@ async def InitConnection():
     init_begin = None
     init_delta = None
     if TIME_CONNECT: init_begin = datetime.now().timestamp()
-    websocket = await AlienConnect()
+    websocket = AlienWebSocket(await AlienConnect())
 
     # no matter if command or interactive mode, we need alienHome, currentdir, user and commandlist
-    if not AlienSessionInfo['commandlist']: await getSessionVars(websocket)
+    # the ones cached by a previous session of the same identity on the same server spare the commandlist request
+    if not AlienSessionInfo['commandlist'] and not session_cache_load(): await getSessionVars(websocket)
     if init_begin:
         init_delta = datetime.now().timestamp() - init_begin
         print(">>>   Time for websocket initialization + sessionVars : {}".format(init_delta), flush = True)
@@ -1179,18 +3144,86 @@ async def getSessionVars(wb):
     AlienSessionInfo['commandlist'].sort()
     AlienSessionInfo['user'] = json_dict["metadata"]["user"]
 
+    server_currentdir = json_dict["metadata"]["currentdir"]
+    if not AlienSessionInfo['alienHome']: AlienSessionInfo['alienHome'] = server_currentdir  # this is first query so current dir is alienHOME
+
     # if we were intrerupted and re-connect than let's get back to the old currentdir
-    if AlienSessionInfo['currentdir'] and not AlienSessionInfo['currentdir'] == json_dict["metadata"]["currentdir"]:
-        tmp_res = SendMsg(wb, 'cd', [AlienSessionInfo['currentdir']])
-    AlienSessionInfo['currentdir'] = json_dict["metadata"]["currentdir"]
-    if not AlienSessionInfo['alienHome']: AlienSessionInfo['alienHome'] = AlienSessionInfo['currentdir']  # this is first query so current dir is alienHOME
+    if AlienSessionInfo['currentdir'] and not AlienSessionInfo['currentdir'] == server_currentdir:
+        cd_dict = json.loads(await SendMsg(wb, 'cd', [AlienSessionInfo['currentdir']]))
+        server_currentdir = cd_dict["metadata"].get("currentdir", server_currentdir)
+    AlienSessionInfo['currentdir'] = server_currentdir
+    session_cache_save()
+
+
+def session_cache_fn() -> str:
+    import hashlib
+    identity = AlienSessionInfo['cert_subject'] + '@' + AlienSessionInfo['server']
+    return CACHE_DIR + '/session/' + hashlib.sha1(identity.encode()).hexdigest()[:16] + '.json'  # not in CACHE_CONTENT, which is evicted
+
+
+def session_cache_load() -> bool:
+    """Fill user, home, current dir and command list from the cache of this identity and server if not expired"""
+    if SESSION_TTL <= 0 or not AlienSessionInfo['cert_subject']: return False
+    try:
+        with open(session_cache_fn()) as f: session = json.load(f)
+    except Exception:
+        return False
+    if time.time() - session['ts'] > SESSION_TTL: return False
+    AlienSessionInfo['user'] = session['user']
+    AlienSessionInfo['alienHome'] = session['alienHome']
+    AlienSessionInfo['currentdir'] = session['alienHome']  # a new connection starts in the home directory
+    AlienSessionInfo['commandlist'] = session['commandlist']
+    return True
+
+
+def session_cache_save():
+    if SESSION_TTL <= 0 or not AlienSessionInfo['cert_subject']: return
+    session = {'user': AlienSessionInfo['user'], 'alienHome': AlienSessionInfo['alienHome'], 'commandlist': AlienSessionInfo['commandlist'], 'ts': time.time()}
+    session_file = session_cache_fn()
+    try:
+        Path(session_file).parent.mkdir(parents = True, exist_ok = True)
+        with open(session_file + '.' + str(os.getpid()), 'w') as f: json.dump(session, f)
+        os.replace(session_file + '.' + str(os.getpid()), session_file)
+    except OSError:
+        logging.debug(traceback.format_exc())
 
 
 async def cwd_list(wb):
     if not wb: return
     result = await SendMsg(wb, 'ls', ['-nokeys', '-F'])
-    result_dict = json.loads(result)
-    AlienSessionInfo['cwd_list'] = list(item['message'] for item in result_dict['results'])
+    listing = JsonAnswer(result)
+    AlienSessionInfo['cwd_list'] = list(item['message'] for item in listing.results())
+    AlienSessionInfo['cwd_index'] = sorted(AlienSessionInfo['cwd_list'])
+    AlienSessionInfo['cwd_list_dir'] = listing.metadata.get("currentdir", AlienSessionInfo['currentdir'])
+    AlienSessionInfo['cwd_list_time'] = time.time()
+
+
+def cwd_list_invalidate():
+    AlienSessionInfo['cwd_list_time'] = 0
+
+
+async def cwd_list_ensure(wb):
+    """Refresh the listing of the current directory only if it belongs to another directory or it is expired"""
+    if AlienSessionInfo['cwd_list_dir'] == AlienSessionInfo['currentdir'] and (time.time() - AlienSessionInfo['cwd_list_time']) < CWD_LIST_TTL: return
+    await cwd_list(wb)
+
+
+def path_is_relative_grid(path: str) -> bool:
+    """True for arguments that expand_path_grid can only resolve with the listing of the current directory"""
+    if not path or path.startswith('-'): return False
+    return not re.match(r"^(\/|\%ALIEN|\.)", path)
+
+
+def prepare_server_args(cmd: str, args: list) -> list:
+    """Arguments of a command sent as such to the server: expanded paths and the output format"""
+    if args != ['-h'] and (cmd == 'ls' or cmd == "stat" or cmd == "xrdstat" or cmd == "rm" or cmd == "lfn2guid"):
+        # or cmd == "find" # find expect pattern after lfn, and if pattern is . it will be replaced with current dir
+        for i, arg in enumerate(args):
+            args[i] = expand_path_grid(args[i])
+            args[i] = re.sub(r"\/{2,}", "/", args[i])
+
+    if not (DEBUG or JSON_OUT or JSONRAW_OUT or NDJSON_OUT): args.insert(0, '-nokeys')
+    return args
 
 
 async def ProcessInput(wb, cmd_string = '', shellcmd = None):
@@ -1201,12 +3234,10 @@ async def ProcessInput(wb, cmd_string = '', shellcmd = None):
 
     cwd_grid_path = Path(AlienSessionInfo['currentdir'])
     home_grid_path = Path(AlienSessionInfo['alienHome'])
-    await cwd_list(wb)  # let's start knowing what is the content of grid current dir
 
     usercert = os.getenv('X509_USER_CERT', Path.home().as_posix() + '/.globus' + '/usercert.pem')
     # userkey = os.getenv('X509_USER_KEY', Path.home().as_posix() + '/.globus' + '/userkey.pem')
     tokencert = os.getenv('JALIEN_TOKEN_CERT', os.getenv('TMPDIR', '/tmp') + '/tokencert_' + str(os.getuid()) + '.pem')
-    tokenkey = os.getenv('JALIEN_TOKEN_KEY', os.getenv('TMPDIR', '/tmp') + '/tokenkey_' + str(os.getuid()) + '.pem')
 
     # implement a time command for measurement of sent/recv delay
     message_begin = None
@@ -1225,22 +3256,24 @@ async def ProcessInput(wb, cmd_string = '', shellcmd = None):
         return AlienSessionInfo['exitcode']
 
     if cmd == 'token':
-        if len(args) > 0 and args[0] == 'refresh':
-            os.remove(tokencert)
-            os.remove(tokenkey)
-            try:
-                wb = await InitConnection()
-            except Exception as e:
-                logging.error(traceback.format_exc())
-                wb = await InitConnection()
-            return int(0)
+        if len(args) > 0 and args[0] == 'refresh':  # a new token over the current connection
+            await token(wb, float('inf'))
+            AlienSessionInfo['exitcode'] = int(0) if IsValidCert(tokencert) else int(1)
+            return AlienSessionInfo['exitcode']
         if not args or (len(args) > 0 and args[0] == 'info'):
             AlienSessionInfo['exitcode'] = CertInfo(tokencert)
             return AlienSessionInfo['exitcode']
 
+    await token_renew_check(wb)
+
+    # the content of grid current dir is needed only for relative paths; the listing is cached between commands
+    if cmd in CMDS_EXPAND_PATH and any(path_is_relative_grid(arg) for arg in args): await cwd_list_ensure(wb)
+    if cmd in CMDS_CWD_MUTATING: cwd_list_invalidate()
+
     if (cmd == "?") or (cmd == "help"):
         if len(args) > 0:
             cmd = args.pop(0)
+            if cmd not in AlienSessionInfo['commandlist']: await getSessionVars(wb)  # the cached command list could be outdated
             if cmd in AlienSessionInfo['commandlist']:
                 args.clear()
                 args.append('-h')
@@ -1248,12 +3281,15 @@ async def ProcessInput(wb, cmd_string = '', shellcmd = None):
             print(' '.join(AlienSessionInfo['commandlist']), flush = True)
             return int(0)
     elif (cmd.startswith("quota")):
-        await DO_quota(wb, args)
-        return int(0)
+        AlienSessionInfo['exitcode'] = await DO_quota(wb, args)
+        return AlienSessionInfo['exitcode']
+    elif cmd == 'head' or cmd == 'tail' or (cmd == 'cat' and '-r' in args):
+        AlienSessionInfo['exitcode'] = await DO_partial_read(wb, cmd, args, shellcmd)
+        return AlienSessionInfo['exitcode']
     elif (cmd.startswith("cat")):
         if args[0] != '-h':
-            await DO_cat(wb, args[0])
-            return int(0)
+            AlienSessionInfo['exitcode'] = await DO_cat(wb, args[0], shellcmd)
+            return AlienSessionInfo['exitcode']
     elif (cmd.startswith("less")):
         if args[0] != '-h':
             await DO_less(wb, args[0])
@@ -1271,74 +3307,153 @@ async def ProcessInput(wb, cmd_string = '', shellcmd = None):
         if args[0] != '-h':
             await DO_edit(wb, args[0], editor=cmd)
             return int(0)
+    elif cmd == 'stats':
+        AlienSessionInfo['exitcode'] = DO_stats(args)
+        return AlienSessionInfo['exitcode']
+    elif cmd == 'watch':
+        AlienSessionInfo['exitcode'] = await DO_watch(wb, args)
+        return AlienSessionInfo['exitcode']
+    elif cmd == 'bulksubmit':
+        AlienSessionInfo['exitcode'] = await DO_bulksubmit(wb, args)
+        return AlienSessionInfo['exitcode']
+    elif cmd == 'bulkstat':
+        AlienSessionInfo['exitcode'] = await DO_bulkstat(wb, args)
+        return AlienSessionInfo['exitcode']
+    elif cmd == 'find' and FIND_PAGESIZE > 0 and not shellcmd and not (DEBUG or JSON_OUT or JSONRAW_OUT) and len(args) > 1 and '-h' not in args and '-x' not in args and not args[-2].startswith('-'):
+        AlienSessionInfo['exitcode'] = await DO_find_paginated(wb, args)
+        return AlienSessionInfo['exitcode']
     elif cmd.startswith("cp"):  # defer cp processing to ProcessXrootdCp
         exitcode = await ProcessXrootdCp(wb, args)
         AlienSessionInfo['exitcode'] = exitcode
         return int(exitcode)
-    elif cmd == 'ls' or cmd == "stat" or cmd == "xrdstat" or cmd == "rm" or cmd == "lfn2guid":
-        # or cmd == "find" # find expect pattern after lfn, and if pattern is . it will be replaced with current dir
-        for i, arg in enumerate(args):
-            args[i] = expand_path_grid(args[i])
-            args[i] = re.sub(r"\/{2,}", "/", args[i])
 
-    if not (DEBUG or JSON_OUT or JSONRAW_OUT): args.insert(0, '-nokeys')
-    result = await SendMsg(wb, cmd, args)
+    args = prepare_server_args(cmd, args)
+    result = await SendMsg_cached(wb, cmd, args)
+    if cmd in CMDS_CATALOGUE_MUTATING: metacache_invalidate(args)
     if message_begin:
         message_delta = datetime.now().timestamp() - message_begin
         print(">>>   Time for send/receive command : {}".format(message_delta), flush = True)
     return int(ProcessReceivedMessage(result, shellcmd))
 
 
+async def ProcessBatch(wb, lines, jobs: int = BATCH_JOBS) -> int:
+    """Run the commands of a script (one or more per line, separated by ;) and print the output of each command in the script order
+    Consecutive read-only commands are sent concurrently, at most jobs at a time; any other command (cd, cp, modifications,
+    pipes to shell, client side commands) waits for all the previous ones and runs alone"""
+    exitcode = int(0)
+    group = []
+
+    async def run_group() -> int:
+        group_exitcode = int(0)
+        if not group: return group_exitcode
+        # relative paths of the whole group are resolved against the same current directory
+        if any(cmd in CMDS_EXPAND_PATH and any(path_is_relative_grid(arg) for arg in args) for cmd, args in group): await cwd_list_ensure(wb)
+        cmd_list = [(cmd, prepare_server_args(cmd, args)) for cmd, args in group]
+        group.clear()
+        async for answer in SendMsg_pipelined(wb, cmd_list, jobs):
+            rc = ProcessReceivedMessage(answer)
+            if rc: group_exitcode = rc
+        return group_exitcode
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'): continue
+        for token in line.split(';'):
+            input_list = token.split()
+            if not input_list: continue
+            if input_list[0] in CMDS_READONLY and '|' not in token:
+                group.append((input_list[0], input_list[1:]))
+                continue
+            rc = await run_group()
+            if rc: exitcode = rc
+            pipe_to_shell_cmd = None
+            if '|' in token:
+                token, pipe_to_shell_cmd = token.split('|', maxsplit = 1)
+            rc = await ProcessInput(wb, ' '.join(token.split()), pipe_to_shell_cmd)
+            if rc: exitcode = rc
+    rc = await run_group()
+    if rc: exitcode = rc
+    AlienSessionInfo['exitcode'] = exitcode
+    return exitcode
+
+
 def ProcessReceivedMessage(message='', shellcmd = None):
     if not message: return int(61)  # ENODATA
     global AlienSessionInfo
-    json_dict = json.loads(message)
-    AlienSessionInfo['currentdir'] = json_dict["metadata"]["currentdir"]
+    answer = JsonAnswer(message)  # the results are decoded one by one while rendered
+    scan_time = answer.decode_time
+
+    def record_times(render_begin: float = None):
+        """decode: scan and decoding of the results, render: the rest of the output, the two being interleaved"""
+        stats.record('decode', answer.decode_time, len(message))
+        if render_begin: stats.record('render', max(time.time() - render_begin - (answer.decode_time - scan_time), 0))
+
+    metadata = answer.metadata
+    AlienSessionInfo['currentdir'] = metadata["currentdir"]
 
     error = ''
-    if 'error' in json_dict["metadata"]:
-        error = json_dict["metadata"]["error"]
+    if 'error' in metadata:
+        error = metadata["error"]
         AlienSessionInfo['error'] = error
 
     exitcode = '0'  # use a default value for cases where exitcode is missing
-    if 'exitcode' in json_dict["metadata"]:
-        exitcode = json_dict["metadata"]["exitcode"]
+    if 'exitcode' in metadata:
+        exitcode = metadata["exitcode"]
         AlienSessionInfo['exitcode'] = exitcode
 
     if DEBUG or JSON_OUT:  # print nice json for debug or json mode
-        print(json.dumps(json_dict, sort_keys=True, indent=4), flush = True)
+        print(json.dumps(json.loads(message), sort_keys=True, indent=4), flush = True)
+        record_times()
         return int(exitcode)
     if JSONRAW_OUT:  # print the raw byte stream received from the server
         print(message, flush = True)
+        record_times()
+        return int(exitcode)
+
+    if NDJSON_OUT:  # a compact json object per result, written as they are serialized
+        if error and exitcode and (exitcode != "0"): print(f'exitcode: {exitcode} ; err: {error}', file = sys.stderr, flush = True)
+        begin = time.time()
+        write_stream(((json.dumps(item, separators = (',', ':')) + '\n').encode() for item in answer.results()), shellcmd)
+        record_times(begin)
         return int(exitcode)
 
     if error and exitcode and (exitcode != "0"): print(f'exitcode: {exitcode} ; err: {error}', flush = True)
 
-    websocket_output = '\n'.join(str(item['message']) for item in json_dict['results'])
-    if not websocket_output:
+    begin = time.time()
+    results = answer.results()
+    first = next(results, None)
+    second = next(results, None) if first is not None else None
+    if first is None or (second is None and not str(first['message'])):
+        record_times()
         if not exitcode: exitcode = 61  # ENODATA
         return int(exitcode)
 
-    if shellcmd:
-        # shlex.split(shellcmd)
-        # shlex.quote(shellcmd)
-        shell_run = subprocess.run(shellcmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, input=websocket_output, encoding='ascii', shell=True, env=os.environ)
-        stdout = shell_run.stdout
-        if stdout: print(stdout, flush = True)
-        stderr = shell_run.stderr
-        if stderr: print(stderr, flush = True)
-    else:
-        print(websocket_output, flush = True)
-
+    # each message is written (to stdout or to the shell command) as it is rendered, no joined copy of the output
+    results = itertools.chain([first], [second] if second is not None else [], results)
+    write_stream(((str(item['message']) + '\n').encode() for item in results), shellcmd)
+    record_times(begin)
     return int(exitcode)
 
 
-async def JAlien(commands = ''):
+async def JAlien(commands = '', script = None):
     global AlienSessionInfo
 
     websocket = None
     while websocket is None: websocket = await InitConnection()  # we are doing the connection recovery and exception treatment in AlienConnect()
 
+    # Batch mode: commands read from a file or stdin
+    if script:
+        try:
+            script_file = sys.stdin if script == '-' else open(script)
+        except OSError as e:
+            print(f"Could not open {script} : {e}", flush = True)
+            AlienSessionInfo['exitcode'] = int(2)  # ENOENT /* No such file or directory */
+            return int(2)
+        try:
+            return await ProcessBatch(websocket, script_file, BATCH_JOBS)
+        finally:
+            if script_file is not sys.stdin: script_file.close()
+
     # Command mode interaction
     if commands:
         cmds_tokens = commands.split(";")
@@ -1346,7 +3461,11 @@ async def JAlien(commands = ''):
         return int(AlienSessionInfo['exitcode'])
 
     # Begin Shell-like interaction
-    if has_readline: setupHistory()  # enable history saving
+    completer = None
+    if has_readline:
+        setupHistory()  # enable history saving
+        completer = setupCompleter()
+        completer.listing(AlienSessionInfo['currentdir'])
 
     print('Welcome to the ALICE GRID\nsupport mail: adrian.sevcenco@cern.ch\n', flush=True)
     while True:
@@ -1404,13 +3523,16 @@ async def JAlien(commands = ''):
                 ping = await websocket.ping()
             except Exception as e:
                 logging.error(traceback.format_exc())
-                websocket = await InitConnection()
+                if not await websocket.reconnect(websocket.generation): websocket = await InitConnection()
 
             await ProcessInput(websocket, ' '.join(input_list), pipe_to_shell_cmd)
+            if completer:
+                if input_list[0] in CMDS_CWD_MUTATING or input_list[0] == 'cp': completer.invalidate(AlienSessionInfo['currentdir'])
+                completer.listing(AlienSessionInfo['currentdir'])  # prefetch the (new) current directory
 
 
 def main():
-    global JSON_OUT, JSONRAW_OUT
+    global JSON_OUT, JSONRAW_OUT, NDJSON_OUT, BATCH_JOBS, profiler
     # alien.py log file
     alienpy_logfile = Path.home().as_posix() + '/alien_py.log'
     # alienpy_logfile_wb = Path.home().as_posix() + '/alien_py_wb.log'
@@ -1425,16 +3547,35 @@ def main():
     # at exit delete all temporary files
     atexit.register(cleanup_temp)
 
+    if PROFILE:
+        profiler = SessionProfiler(PROFILE, PROFILE_FILE)
+        atexit.register(profiler.stop)  # for the exits of the interactive mode
+        profiler.start()
+
     sys.argv.pop(0)  # remove the name of the script(alien.py)
     if '-json' in sys.argv:
         sys.argv.remove('-json')
         JSON_OUT = 1
+    if '-ndjson' in sys.argv:
+        sys.argv.remove('-ndjson')
+        NDJSON_OUT = 1
     if '-jsonraw' in sys.argv:
         sys.argv.remove('-jsonraw')
         JSONRAW_OUT = 1
 
+    script = None
+    if len(sys.argv) > 1 and sys.argv[0] == '-f':  # alien.py -f <script | -> [-T nr_commands_in_flight]
+        sys.argv.pop(0)
+        script = sys.argv.pop(0)
+        if '-T' in sys.argv:
+            jobs_idx = sys.argv.index('-T')
+            BATCH_JOBS = int(sys.argv.pop(jobs_idx + 1))
+            sys.argv.pop(jobs_idx)
+
     cmd_string = ' '.join(sys.argv)
-    asyncio.get_event_loop().run_until_complete(JAlien(cmd_string))
+    asyncio.get_event_loop().run_until_complete(JAlien(cmd_string, script))
+    if STATS_FILE: stats.dump(STATS_FILE)  # os._exit does not run the atexit handlers
+    if profiler: profiler.stop()
     os._exit(int(AlienSessionInfo['exitcode']))
 
 